@@ -1,12 +1,36 @@
 import requests
-import uuid
+import os
+import queue
 import json
+import hashlib
+import heapq
+import itertools
+import random
+import socket
+import sqlite3
+import threading
+import time
+import asyncio
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, Iterator, NamedTuple, Callable, Union, FrozenSet, AbstractSet, Tuple, Iterable, Deque, Sequence, Awaitable
+from requests.adapters import HTTPAdapter
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, field, replace
 from enum import Enum, auto
 
+try:
+    import aiohttp
+except ImportError:  # aiohttp is only needed for AsyncYouChat
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional, faster JSON backend
+    orjson = None
+
 
 class ModelNotAvailableError(Exception):
     """Custom exception raised when an unavailable model is requested."""
@@ -18,6 +42,52 @@ class ChatModeNotAvailableError(Exception):
     pass
 
 
+class HTTPStatusError(Exception):
+    """Custom exception raised when the API answers with an error status instead of a stream."""
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"YouChat API returned HTTP {status}.")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class EndpointConfigError(Exception):
+    """Custom exception raised when an endpoint configuration is invalid."""
+    pass
+
+
+class StreamTimeoutError(Exception):
+    """Custom exception raised when a stream exceeds one of its Timeouts; `limit` names which one."""
+
+    def __init__(self, limit: str, elapsed: float):
+        super().__init__(f"YouChat stream exceeded its {limit} timeout after {elapsed:.2f}s.")
+        self.limit = limit
+        self.elapsed = elapsed
+
+
+class CircuitOpenError(Exception):
+    """Custom exception raised when a model's circuit breaker is open and no fallback model is available."""
+
+    def __init__(self, model: 'AIModelEnum', retry_after: float):
+        super().__init__(f"Circuit breaker for {model.name} is open; trial calls resume in {retry_after:.2f}s.")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class StreamInterruptedError(Exception):
+    """Custom exception raised to readers of a coalesced stream whose upstream read was interrupted."""
+    pass
+
+
+class RateLimitExceeded(Exception):
+    """Custom exception raised when a RateLimiter refuses a request; `retry_after` is the estimated wait."""
+
+    def __init__(self, model: 'AIModelEnum', retry_after: float):
+        super().__init__(f"Rate limit for {model.name} reached; capacity frees up in {retry_after:.2f}s.")
+        self.model = model
+        self.retry_after = retry_after
+
+
 class AIModelEnum(Enum):
     """Enum to manage available AI models."""
     OPENAI_O1 = 'openai_o1'
@@ -58,6 +128,228 @@ class ChatModeEnum(Enum):
     DEFAULT = 'default'
 
 
+class StreamEventType(Enum):
+    """Enum of the typed events yielded while a response streams in."""
+    TOKEN = 'youChatToken'
+    QUERY = 'query'
+    RELATED_SEARCHES = 'relatedSearches'
+    MESSAGE = 'message'
+    DONE = 'done'
+
+
+# SSE event names whose payloads are decoded by default; every other event is skipped unparsed
+DEFAULT_STREAM_EVENTS: FrozenSet[str] = frozenset({'youChatToken', 'query', 'relatedSearches'})
+TOKEN_EVENTS: FrozenSet[str] = frozenset({'youChatToken'})
+
+
+@dataclass
+class StreamEvent:
+    """A single typed event parsed from the response stream.
+
+    MESSAGE events carry the decoded payload of any other subscribed SSE event, with its name in `name`.
+    """
+    type: StreamEventType
+    data: Any = None
+    name: Optional[str] = None
+
+
+# RFC 3986 unreserved characters are the only ones sent as-is in a query component
+_UNRESERVED_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+
+DEFAULT_FEATURE_FLAGS: FrozenSet[str] = frozenset({
+    'enable_worklow_generation_ux', 'use_personalization_extraction', 'enable_agent_clarification_questions',
+    'use_nested_youchat_updates',
+})
+SAFE_SEARCH_LEVELS: FrozenSet[str] = frozenset({'Off', 'Moderate', 'Strict'})
+# Parameters filled in per request by RequestBuilder, which extra_params must not override
+_REQUEST_PARAMS: FrozenSet[str] = frozenset({
+    'q', 'chat', 'chatId', 'queryTraceId', 'conversationTurnId', 'pastChatLength', 'selectedChatMode',
+    'selectedAiModel', 'traceId',
+})
+
+
+@dataclass(frozen=True)
+class EndpointConfig:
+    """Immutable description of the streamingSearch endpoint and its static query parameters.
+
+    The defaults reproduce the parameters the client has always sent. Set `utm` or `count` to None,
+    or remove names from `feature_flags`, to leave them out of the request; `count=None` skips the
+    web search results the client never reads. A `base_url` of None uses the client's base_url.
+    """
+    base_url: Optional[str] = None
+    path: str = '/api/streamingSearch'
+    mkt: str = 'en-IN'
+    utm: Optional[str] = 'brave'
+    count: Optional[int] = 10
+    page: int = 1
+    safe_search: str = 'Moderate'
+    domain: str = 'youchat'
+    feature_flags: FrozenSet[str] = DEFAULT_FEATURE_FLAGS
+    extra_params: Tuple[Tuple[str, str], ...] = ()
+
+    def __post_init__(self):
+        if self.base_url is not None:
+            if not self.base_url.startswith(('http://', 'https://')) or any(c in self.base_url for c in '?#'):
+                raise EndpointConfigError(f"base_url must be an http(s) URL without query or fragment, got {self.base_url!r}.")
+            object.__setattr__(self, 'base_url', self.base_url.rstrip('/'))
+        if not self.path.startswith('/'):
+            raise EndpointConfigError(f"path must start with '/', got {self.path!r}.")
+        if not self.mkt or not self.domain:
+            raise EndpointConfigError("mkt and domain must not be empty.")
+        if self.count is not None and not (isinstance(self.count, int) and 1 <= self.count <= 50):
+            raise EndpointConfigError(f"count must be None or an integer between 1 and 50, got {self.count!r}.")
+        if not isinstance(self.page, int) or self.page < 1:
+            raise EndpointConfigError(f"page must be a positive integer, got {self.page!r}.")
+        if self.safe_search not in SAFE_SEARCH_LEVELS:
+            raise EndpointConfigError(f"safe_search must be one of {sorted(SAFE_SEARCH_LEVELS)}, got {self.safe_search!r}.")
+        flags = frozenset(self.feature_flags)
+        for name in flags | {name for name, _ in self.extra_params}:
+            if not name or set(name) - _UNRESERVED_CHARS:
+                raise EndpointConfigError(f"Invalid query parameter name {name!r}.")
+        clashes = _REQUEST_PARAMS & {name for name, _ in self.extra_params}
+        if clashes:
+            raise EndpointConfigError(f"extra_params cannot override per-request parameters {sorted(clashes)}.")
+        object.__setattr__(self, 'feature_flags', flags)
+        object.__setattr__(self, 'extra_params', tuple((name, str(value)) for name, value in self.extra_params))
+
+    def static_params(self) -> List[Tuple[str, str]]:
+        """The (name, value) pairs sent unchanged with every request, in a stable order."""
+        params = [('page', str(self.page))]
+        if self.count is not None:
+            params.append(('count', str(self.count)))
+        params.append(('safeSearch', self.safe_search))
+        if self.utm is not None:
+            params.append(('utm', self.utm))
+        params += [('mkt', self.mkt), ('domain', self.domain)]
+        params += [(name, 'true') for name in sorted(self.feature_flags)]
+        params += self.extra_params
+        return params
+
+
+_RETRYABLE_ERRORS: Tuple[type, ...] = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+if aiohttp is not None:
+    _RETRYABLE_ERRORS += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+class RetryBudget:
+    """Thread-safe cap on retries shared by every policy and client that uses it.
+
+    Each request deposits `ratio` retries and `min_per_second` more accrue over time, up to
+    `max_balance`. A retry is only allowed while the balance covers it, so during an outage retries
+    add at most about `ratio` extra load instead of multiplying it.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1.0, max_balance: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self._lock = threading.Lock()
+        self._balance = min(max(min_per_second, 1.0), max_balance)
+        self._updated = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.rejected = 0
+
+    def _refill(self, amount: float):
+        now = time.monotonic()
+        self._balance = min(self.max_balance, self._balance + amount + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        """Records an original (non-retry) request."""
+        with self._lock:
+            self.requests += 1
+            self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        """Takes one retry from the budget, returning False when it is exhausted."""
+        with self._lock:
+            self._refill(0.0)
+            if self._balance >= 1.0:
+                self._balance -= 1.0
+                self.retries += 1
+                return True
+            self.rejected += 1
+            return False
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'requests': self.requests, 'retries': self.retries, 'rejected': self.rejected}
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """When and how often a stream is retried.
+
+    Only connection errors, timeouts, broken streams and `retry_statuses` responses are retried,
+    and only until the first youChatToken has been received; later failures are raised because
+    the caller has already seen part of the answer. Delays grow exponentially from `base_delay`
+    up to `max_delay`, with `jitter` (0 to 1) of each delay randomized, and respect Retry-After:
+    a response asking to wait longer than `max_delay` or the time left for the call is not retried.
+    """
+    max_attempts: int = 3
+    base_delay: float = 0.2
+    max_delay: float = 5.0
+    multiplier: float = 2.0
+    jitter: float = 1.0
+    retry_statuses: FrozenSet[int] = frozenset({408, 429, 500, 502, 503, 504})
+    budget: Optional[RetryBudget] = None
+
+    def record_request(self):
+        if self.budget is not None:
+            self.budget.deposit()
+
+    def is_retryable(self, error: BaseException) -> bool:
+        if isinstance(error, HTTPStatusError):
+            return error.status in self.retry_statuses
+        if isinstance(error, StreamTimeoutError):
+            return error.limit == 'connect'
+        return isinstance(error, _RETRYABLE_ERRORS)
+
+    def should_retry(self, error: BaseException, attempt: int, remaining: Optional[float] = None) -> bool:
+        """Whether to make another attempt after `attempt` failed with `error`; spends budget when it says yes.
+
+        `remaining` is the time left for the whole call, if it is bounded.
+        """
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return False
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None and (retry_after > self.max_delay or (remaining is not None and retry_after > remaining)):
+            # Retrying before the server is ready again would only add to its load
+            return False
+        return self.budget is None or self.budget.withdraw()
+
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """Seconds to wait before the attempt after `attempt`."""
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        delay *= 1.0 - self.jitter * random.random()
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+@dataclass(frozen=True)
+class Timeouts:
+    """Limits for one call, in seconds; None disables a limit.
+
+    `connect` bounds opening the connection, `first_token` the wait for the first youChatToken,
+    `idle` the gap between tokens, and `total` the whole call including retries.
+    """
+    connect: Optional[float] = 10.0
+    first_token: Optional[float] = 120.0
+    idle: Optional[float] = 60.0
+    total: Optional[float] = None
+
+    @property
+    def read_backstop(self) -> Optional[float]:
+        """Socket read timeout that can only fire after one of the stream limits has already passed."""
+        limits = [limit for limit in (self.first_token, self.idle, self.total) if limit is not None]
+        return max(limits) * 1.01 if limits else None
+
+
 @dataclass
 class YouChatConfig:
     """Dataclass to hold configuration for the YouChat request."""
@@ -65,124 +357,3001 @@ class YouChatConfig:
     chat_mode: ChatModeEnum
     query: str
     prints: bool = True
+    pool_connections: int = 10
+    pool_maxsize: int = 10
+    keep_alive: bool = True
+    events: FrozenSet[str] = DEFAULT_STREAM_EVENTS
+    base_url: Optional[str] = None  # shorthand for endpoint.base_url, e.g. a local MockStreamingServer
+    endpoint: EndpointConfig = field(default_factory=EndpointConfig)
+    retry: Optional[RetryPolicy] = None
+    timeouts: Timeouts = field(default_factory=Timeouts)
+    hedge: Optional['HedgePolicy'] = None
 
+    def __post_init__(self):
+        if self.base_url:
+            if self.endpoint.base_url is not None and self.endpoint.base_url != self.base_url.rstrip('/'):
+                raise EndpointConfigError("base_url and endpoint.base_url disagree; set only one of them.")
+            self.endpoint = replace(self.endpoint, base_url=self.base_url)
 
-class YouChatAPI(ABC):
-    """Abstract base class to define a structure for interacting with the YouChat API."""
 
-    @abstractmethod
-    def prepare_query(self, query: str) -> str:
-        """Prepares and encodes the query string for the API."""
-        pass
+class ConnectionPoolStats:
+    """Thread-safe counters describing how often pooled connections are reused."""
 
-    @abstractmethod
-    def send_request(self, query: str, config: YouChatConfig) -> Dict[str, Any]:
-        """Sends the request to the YouChat API and returns the response."""
-        pass
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requests = 0
+        self.misses = 0
 
-    @abstractmethod
-    def handle_response(self, response: requests.Response) -> Dict[str, Any]:
-        """Handles the response from the API."""
-        pass
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
 
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
 
-class YouChat(YouChatAPI):
-    """Concrete implementation of YouChatAPI to interact with YouChat's API."""
+    def record_connect(self, seconds: float):
+        self._local.connect_time = seconds
 
-    available_models: Dict[str, AIModelEnum] = {model.name: model for model in AIModelEnum}
-    available_chat_modes: List[ChatModeEnum] = list(ChatModeEnum)
+    def take_connect_time(self) -> Optional[float]:
+        """Returns and clears how long the calling thread last spent opening a new connection."""
+        seconds = getattr(self._local, 'connect_time', None)
+        self._local.connect_time = None
+        return seconds
 
-    def __init__(self, config: YouChatConfig):
-        self.config = config
-        self.validate_configuration(config)
+    @property
+    def hits(self) -> int:
+        """Requests that were served over an already open connection."""
+        return max(self.requests - self.misses, 0)
 
-    def validate_configuration(self, config: YouChatConfig):
-        """Validates the configuration for model and chat mode."""
-        if not isinstance(config.model, AIModelEnum):
-            raise ModelNotAvailableError(f"Model {config.model} is not available.")
-        
-        if not isinstance(config.chat_mode, ChatModeEnum):
-            raise ChatModeNotAvailableError(f"Chatmode {config.chat_mode} is not available.")
+    def snapshot(self) -> Dict[str, int]:
+        """Returns a consistent copy of the counters."""
+        with self._lock:
+            return {'requests': self.requests, 'hits': max(self.requests - self.misses, 0), 'misses': self.misses}
 
-    def prepare_query(self, query: str) -> str:
-        """Encodes the query to ensure it's properly formatted for the request."""
-        replacements = {
-            ' ': '%20', '?': '%3F', '&': '%26', '"': '%22', "'": '%27', ',': '%2C',
-            ';': '%3B', ':': '%3A', '/': '%2F', '\\': '%5C', '|': '%7C', '=': '%3D', '+': '%2B'
-        }
-        for char, replacement in replacements.items():
-            query = query.replace(char, replacement)
-        return query
 
-    def send_request(self, query: str, config: YouChatConfig) -> Dict[str, Any]:
-        """Sends the HTTP request to the YouChat API and returns the response."""
-        query = self.prepare_query(query)
-        cookies = {
-            'safesearch_guest': 'Moderate',
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that reports connection pool hits and misses to a ConnectionPoolStats."""
+
+    def __init__(self, stats: ConnectionPoolStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self.stats
+        pool_classes = {}
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            # Every new connection opened by a pool is a miss; everything else reused a socket.
+            class CountingPool(pool_cls):
+                def _new_conn(self):
+                    stats.record_miss()
+                    conn = super()._new_conn()
+                    connect = conn.connect
+
+                    def timed_connect():
+                        start = time.perf_counter()
+                        connect()
+                        stats.record_connect(time.perf_counter() - start)
+                    conn.connect = timed_connect
+                    return conn
+            pool_classes[scheme] = CountingPool
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+    def send(self, request, *args, **kwargs):
+        self.stats.record_request()
+        return super().send(request, *args, **kwargs)
+
+
+class PooledSession:
+    """Pooled, keep-alive HTTP session that can be shared across threads and YouChat instances."""
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 10, keep_alive: bool = True):
+        self.stats = ConnectionPoolStats()
+        self.session = requests.Session()
+        adapter = CountingHTTPAdapter(self.stats, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.pool_maxsize = pool_maxsize
+        self.session.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+
+    @classmethod
+    def from_config(cls, config: YouChatConfig) -> 'PooledSession':
+        """Creates a session sized according to the given configuration."""
+        return cls(config.pool_connections, config.pool_maxsize, config.keep_alive)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Issues a GET request over the pooled connections."""
+        return self.session.get(url, **kwargs)
+
+    def warm_up(self, url: str, connections: int = 1) -> int:
+        """Opens up to `connections` sockets to `url` ahead of time and returns how many succeeded."""
+        connections = max(1, min(connections, self.pool_maxsize))
+
+        def touch(_):
+            try:
+                self.session.head(url, allow_redirects=False).close()
+                return True
+            except requests.RequestException:
+                return False
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            return sum(executor.map(touch, range(connections)))
+
+    def close(self):
+        """Closes every pooled connection."""
+        self.session.close()
+
+
+# str.translate table for ASCII text: index = code point, value = the character itself or its escape
+_PERCENT_ESCAPES: Tuple[str, ...] = tuple(chr(code) if chr(code) in _UNRESERVED_CHARS else f'%{code:02X}' for code in range(128))
+
+
+def percent_encode(text: str) -> str:
+    """Percent-encodes text as UTF-8 per RFC 3986, leaving only unreserved characters unescaped.
+
+    ASCII text is encoded in a single str.translate pass over a 128-entry table; anything else
+    goes through urllib.parse.quote, which encodes once and escapes byte by byte in one pass.
+    """
+    if text.isascii():
+        return text.translate(_PERCENT_ESCAPES)
+    return urllib.parse.quote(text, safe='-._~', errors='surrogatepass')
+
+
+def uuid4_strings(count: int) -> List[str]:
+    """Returns `count` random RFC 4122 version 4 UUID strings from a single os.urandom call."""
+    raw = os.urandom(16 * count).hex()
+    ids = []
+    for start in range(0, 32 * count, 32):
+        h = raw[start:start + 32]
+        ids.append(f'{h[:8]}-{h[8:12]}-4{h[13:16]}-{"89ab"[int(h[16], 16) & 3]}{h[17:20]}-{h[20:32]}')
+    return ids
+
+
+@dataclass
+class ChatContext:
+    """Conversation state sent with a request: the chat ID and the already encoded history."""
+    chat_id: str
+    past_chat_length: int = 0
+    chat: str = '%5B%5D'
+
+
+class RequestBuilder:
+    """Precomputed streamingSearch request template for one (model, chat mode) pair.
+
+    Everything static in the URL and cookies is built once; `build` only fills in the per-request
+    IDs, timestamp and encoded query. Builders are immutable, so one instance can be shared by
+    any number of threads.
+    """
+
+    def __init__(self, model: AIModelEnum, chat_mode: ChatModeEnum, base_url: str = 'https://you.com',
+                 endpoint: Optional[EndpointConfig] = None):
+        self.model = model
+        self.chat_mode = chat_mode
+        self.endpoint = endpoint = endpoint or EndpointConfig()
+        self.base_url = base_url = endpoint.base_url or base_url
+        static_params = ''.join(f'{name}={percent_encode(value)}&' for name, value in endpoint.static_params())
+        self._url_head = f'{base_url}{endpoint.path}?{static_params}queryTraceId='
+        self._url_model = f'&selectedChatMode={chat_mode.value}&selectedAiModel={model.value}&traceId='
+        self._cookies = {
+            'safesearch_guest': endpoint.safe_search,
             'youchat_personalization': 'true',
             'youchat_smart_learn': 'true',
             'youpro_subscription': 'true',
             'guest_has_seen_legal_disclaimer': 'true',
-            'ai_model': str(config.model.value),
+            'ai_model': str(model.value),
             'you_subscription': 'premium',
-            'DS': str(uuid.uuid4())
         }
 
-        response = requests.get(
-            f'https://you.com/api/streamingSearch?page=1&count=10&safeSearch=Moderate&utm=brave&mkt=en-IN&enable_worklow_generation_ux=true&domain=youchat&use_personalization_extraction=true&queryTraceId={uuid.uuid4()}&chatId={uuid.uuid4()}&conversationTurnId={uuid.uuid4()}&pastChatLength=0&selectedChatMode={config.chat_mode.value}&selectedAiModel={config.model.value}&enable_agent_clarification_questions=true&traceId={uuid.uuid4()}|{uuid.uuid4()}|{datetime.now().isoformat()}&use_nested_youchat_updates=true&q={query}&chat=%5B%5D',
-            cookies=cookies,
-            stream=True
-        )
-        return self.handle_response(response)
+    @classmethod
+    def from_config(cls, config: YouChatConfig, base_url: str = 'https://you.com') -> 'RequestBuilder':
+        """Creates a builder for the model and chat mode of the given configuration."""
+        return cls(config.model, config.chat_mode, base_url, config.endpoint)
 
-    def handle_response(self, response: requests.Response) -> Dict[str, Any]:
-        """Handles the API response and extracts relevant data."""
-        response_dict = {'streaming_response': ''}
-        
-        for value in response.iter_lines(decode_unicode=True, chunk_size=1000):
-            if value and 'event:' not in value:
-                value = value.replace('data: ', '')
-                try:
-                    # Attempt to load the JSON response
-                    json_value = json.loads(value)
-                    
-                    # Check if json_value is a list (to handle the structure more flexibly)
-                    if isinstance(json_value, list):
-                        for item in json_value:
-                            if isinstance(item, dict):
-                                related_searches = item.get('relatedSearches')
-                                if related_searches:
-                                    response_dict.update({'relatedSearches': related_searches})
-
-                                query = item.get('query')
-                                if query:
-                                    response_dict.update({'query': item})
-
-                                you_chat_token = item.get('youChatToken')
-                                if you_chat_token:
-                                    content = you_chat_token
-                                    response_dict['streaming_response'] += content
-                                    if self.config.prints:
-                                        print(content, end='', flush=True)
-                    elif isinstance(json_value, dict):
-                        # Handle when the response is directly a dictionary
-                        related_searches = json_value.get('relatedSearches')
-                        if related_searches:
-                            response_dict.update({'relatedSearches': related_searches})
-
-                        query = json_value.get('query')
-                        if query:
-                            response_dict.update({'query': json_value})
-
-                        you_chat_token = json_value.get('youChatToken')
-                        if you_chat_token:
-                            content = you_chat_token
-                            response_dict['streaming_response'] += content
-                            if self.config.prints:
-                                print(content, end='', flush=True)
-                except:continue
+    def build_url(self, query: str, chat: Optional[ChatContext] = None) -> str:
+        """Builds the request URL for an already encoded query, continuing `chat` when given."""
+        query_trace_id, chat_id, turn_id, trace_a, trace_b = uuid4_strings(5)
+        if chat is None:
+            past_chat_length, history = '0', '%5B%5D'
+        else:
+            chat_id, past_chat_length, history = chat.chat_id, str(chat.past_chat_length), chat.chat
+        return ''.join((
+            self._url_head, query_trace_id, '&chatId=', chat_id, '&conversationTurnId=', turn_id,
+            '&pastChatLength=', past_chat_length, self._url_model, trace_a, '|', trace_b, '|',
+            datetime.now().isoformat(), '&q=', query, '&chat=', history,
+        ))
+
+    def build_cookies(self) -> Dict[str, str]:
+        """Returns a fresh cookies dict with a new DS identifier."""
+        cookies = self._cookies.copy()
+        cookies['DS'] = uuid4_strings(1)[0]
+        return cookies
+
+    def build(self, query: str, chat: Optional[ChatContext] = None) -> Tuple[str, Dict[str, str]]:
+        """Returns the (url, cookies) pair for one request with an already encoded query."""
+        return self.build_url(query, chat), self.build_cookies()
+
+
+_raw_decode = json.JSONDecoder().raw_decode
+
+
+def _stdlib_json_loads(data: bytes) -> Any:
+    text = data.decode('utf-8', errors='replace')
+    # raw_decode skips json.loads' type checks and whitespace regexes; payloads with surrounding
+    # whitespace or errors go through json.loads so the result and the exceptions stay the same
+    try:
+        value, end = _raw_decode(text)
+        if end == len(text):
+            return value
+    except ValueError:
+        pass
+    return json.loads(text)
+
+
+JSON_BACKENDS: Dict[str, Callable[[bytes], Any]] = {'json': _stdlib_json_loads}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = orjson.loads
+
+# Stream payloads are decoded with the fastest installed backend unless set_json_backend picks another
+_json_loads: Callable[[bytes], Any] = JSON_BACKENDS.get('orjson', _stdlib_json_loads)
+
+
+def set_json_backend(backend: Union[str, Callable[[bytes], Any]]):
+    """Selects the function used to decode stream payloads, by name ('json', 'orjson') or as a callable.
+
+    A callable receives the raw payload bytes and must raise ValueError on invalid JSON.
+    """
+    global _json_loads
+    if callable(backend):
+        _json_loads = backend
+    elif backend in JSON_BACKENDS:
+        _json_loads = JSON_BACKENDS[backend]
+    else:
+        raise ValueError(f"JSON backend {backend!r} is not available. Choose from {sorted(JSON_BACKENDS)}.")
+
+
+def get_json_backend() -> Callable[[bytes], Any]:
+    """Returns the function currently used to decode stream payloads."""
+    return _json_loads
+
+
+class SSEMessage(NamedTuple):
+    """One dispatched server-sent event; `data` stays raw bytes until it is decoded."""
+    event: str = 'message'
+    data: bytes = b''
+    id: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        return self.data.decode('utf-8', errors='replace')
+
+
+class _MessageRun(Sequence[SSEMessage]):
+    # The events of one _parse_simple run. Messages are only built while the caller iterates, so
+    # a consumer that counts events or stops early does not pay for tuples it never looks at.
+    __slots__ = ('_names', '_payloads', '_id')
+
+    def __init__(self, names: List[str], payloads: List[bytes], id: Optional[str]):
+        self._names = names
+        self._payloads = payloads
+        self._id = id
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        return SSEMessage(self._names[index], self._payloads[index], self._id)
+
+    def __iter__(self) -> Iterator[SSEMessage]:
+        count = len(self._payloads)
+        return map(tuple.__new__, itertools.repeat(SSEMessage, count),
+                   zip(self._names, self._payloads, itertools.repeat(self._id, count)))
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+class SSEParser:
+    """Incremental, byte-level parser for the text/event-stream format.
+
+    Feed it raw body chunks of any size; complete events are returned as soon as the blank line
+    that terminates them arrives. Multi-line `data:` fields are joined with newlines and the
+    `event:`, `id:` and `retry:` fields are tracked as described in the HTML SSE specification.
+    """
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self._held_cr = False
+        self._event_names: Dict[bytes, str] = {}
+        self.last_event_id: Optional[str] = None
+        self.retry: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> Sequence[SSEMessage]:
+        """Consumes a chunk of the body and returns the events it completed."""
+        if self._held_cr or b'\r' in chunk:
+            if self._held_cr:
+                chunk = b'\r' + chunk
+            # Cannot tell a lone CR from CRLF until the next byte arrives, so a trailing CR is held back
+            self._held_cr = chunk[-1:] == b'\r'
+            if self._held_cr:
+                chunk = chunk[:-1]
+            chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        parts = self._parts
+        # Earlier parts hold no blank line, so only the new chunk is searched, plus the boundary
+        end = chunk.rfind(b'\n\n')
+        if end == -1:
+            if not (parts and chunk[:1] == b'\n' and parts[-1][-1:] == b'\n'):
+                if chunk:
+                    parts.append(chunk)
+                return []
+            # The blank line straddles the chunk boundary
+            chunk = b''.join(parts) + chunk
+            parts.clear()
+            end = chunk.rfind(b'\n\n')
+        # Everything before the last blank line is complete events and the rest is kept as a part,
+        # so each byte is copied once on the way through and never shifted around in a buffer
+        complete = b''.join(parts) + chunk[:end] if parts else chunk[:end]
+        rest = chunk[end + 2:]
+        parts[:] = [rest] if rest else []
+        messages = self._parse_simple(complete)
+        return messages if messages is not None else self._parse_blocks(complete.split(b'\n\n'))
+
+    def _parse_simple(self, complete: bytes) -> Optional[_MessageRun]:
+        # Fast path for a run of events that all have the `event: <name>\ndata: <payload>` shape,
+        # which is how streamingSearch sends every event. Its lines are then exactly name, payload,
+        # blank, name, payload, ... so the run is checked and split with a few bytes and list
+        # operations, without running Python code per event.
+        # None means some event has another shape and the caller parses block by block.
+        lines = complete.split(b'\n')
+        heads = lines[0::3]
+        count = len(heads)
+        if len(lines) != 3 * count - 1 or lines[2::3].count(b'') != count - 1:
+            return None
+        event_names = self._event_names
+        name = event_names.get(heads[0])
+        if name is not None and heads.count(heads[0]) == count:
+            # Runs of token events share one name, so equal heads need a single lookup
+            names = [name] * count
+        else:
+            names = list(map(event_names.get, heads))
+        if None in names:
+            # First sighting of an event name; a stream only uses a handful, so each is decoded once
+            for index, head in enumerate(heads):
+                if names[index] is None:
+                    if head[:7] != b'event: ':
+                        return None
+                    name = event_names[head] = head[7:].decode('utf-8', errors='replace') or 'message'
+                    names[index] = name
+        payloads = b'\n'.join(lines[1::3])
+        # Lines contain no newline, so each '\ndata: ' marks one more line that starts with the field
+        if payloads[:6] != b'data: ' or payloads.count(b'\ndata: ') != count - 1:
+            return None
+        return _MessageRun(names, payloads[6:].split(b'\ndata: '), self.last_event_id)
+
+    def close(self) -> List[SSEMessage]:
+        """Flushes an event that the stream ended without terminating."""
+        block = b''.join(self._parts).strip(b'\n')
+        self._parts.clear()
+        self._held_cr = False
+        return self._parse_blocks([block]) if block else []
+
+    def _parse_blocks(self, blocks: List[bytes]) -> List[SSEMessage]:
+        messages: List[SSEMessage] = []
+        event_names = self._event_names
+        for block in blocks:
+            # Fast path for the common `event: <name>\ndata: <payload>` shape
+            if block[:7] == b'event: ':
+                head, _, rest = block.partition(b'\n')
+                if rest[:6] == b'data: ' and b'\n' not in rest:
+                    # A stream only uses a handful of event names, so decode each one once
+                    name = event_names.get(head)
+                    if name is None:
+                        name = event_names[head] = head[7:].decode('utf-8', errors='replace') or 'message'
+                    messages.append(SSEMessage(name, rest[6:], self.last_event_id))
+                    continue
+            message = self._parse_block(block)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def _parse_block(self, block: bytes) -> Optional[SSEMessage]:
+        data: List[bytes] = []
+        event = None
+        for line in block.split(b'\n'):
+            if not line or line[0] == 0x3A:  # ':' starts a comment
+                continue
+            field, sep, value = line.partition(b':')
+            if sep and value[:1] == b' ':
+                value = value[1:]
+            if field == b'data':
+                data.append(value)
+            elif field == b'event':
+                event = value.decode('utf-8', errors='replace')
+            elif field == b'id':
+                if b'\0' not in value:
+                    self.last_event_id = value.decode('utf-8', errors='replace')
+            elif field == b'retry':
+                if value.isdigit():
+                    self.retry = int(value)
+        if not data:
+            return None
+        return SSEMessage(event or 'message', b'\n'.join(data), self.last_event_id)
+
+
+def iter_response_bytes(response: requests.Response, chunk_size: int = 8192) -> Iterator[bytes]:
+    """Yields raw body bytes as soon as they arrive instead of waiting to fill fixed-size chunks."""
+    raw = response.raw
+    if getattr(raw, 'chunked', False):
+        yield from response.iter_content(chunk_size=None)
+    elif hasattr(raw, 'read1'):
+        while True:
+            chunk = raw.read1(chunk_size, decode_content=True)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        yield from response.iter_content(chunk_size=chunk_size)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header given in seconds; HTTP-date values are ignored."""
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def message_items(message: SSEMessage) -> List[Dict[str, Any]]:
+    """Decodes the JSON payload of one event into the payload dicts it carries."""
+    try:
+        json_value = _json_loads(message.data)
+    except ValueError:
+        # Tolerate servers that put several JSON documents on consecutive data lines
+        if b'\n' not in message.data:
+            return []
+        return [item for line in message.data.split(b'\n') for item in message_items(SSEMessage(message.event, line))]
+
+    # The payload is either a single dict or a list of them
+    if isinstance(json_value, list):
+        return [item for item in json_value if isinstance(item, dict)]
+    if isinstance(json_value, dict):
+        return [json_value]
+    return []
+
+
+def stream_item_events(item: Dict[str, Any]) -> List[StreamEvent]:
+    """Converts one payload dict into the typed events it carries."""
+    events = []
+    related_searches = item.get('relatedSearches')
+    if related_searches:
+        events.append(StreamEvent(StreamEventType.RELATED_SEARCHES, related_searches))
+
+    query = item.get('query')
+    if query:
+        events.append(StreamEvent(StreamEventType.QUERY, item))
+
+    you_chat_token = item.get('youChatToken')
+    if you_chat_token:
+        events.append(StreamEvent(StreamEventType.TOKEN, you_chat_token))
+    return events
+
+
+# Event names whose payloads are mapped onto the typed token/query/related searches events
+_TYPED_STREAM_EVENTS = frozenset({'message', 'youChatToken', 'query', 'relatedSearches'})
+
+
+def message_events(message: SSEMessage, events: AbstractSet[str] = DEFAULT_STREAM_EVENTS) -> List[StreamEvent]:
+    """Decodes one server-sent event straight into typed events, if anyone subscribed to it.
+
+    Unnamed events are always decoded. Events whose name is not in `events` are dropped before
+    their payload is parsed.
+    """
+    name = message.event
+    if name == 'youChatToken':
+        # Fast path for the event that makes up almost the whole stream
+        if name not in events:
+            return []
+        try:
+            value = _json_loads(message.data)
+        except ValueError:
+            # message_items also handles several JSON documents on consecutive data lines
+            return [event for item in message_items(message) for event in stream_item_events(item)]
+        if type(value) is dict and len(value) == 1:
+            token = value.get('youChatToken')
+            return [StreamEvent(StreamEventType.TOKEN, token)] if token else []
+        return [event for item in message_items(message) for event in stream_item_events(item)]
+
+    if name not in events and name != 'message':
+        return []
+    if name in _TYPED_STREAM_EVENTS:
+        return [event for item in message_items(message) for event in stream_item_events(item)]
+    try:
+        payload = _json_loads(message.data)
+    except ValueError:
+        payload = message.text
+    return [StreamEvent(StreamEventType.MESSAGE, payload, name)]
+
+
+
+class ResponseAccumulator:
+    """Collects streamed events in linear time and only joins the answer text when it is asked for."""
+
+    def __init__(self):
+        self._chunks: List[str] = []
+        self.token_count = 0
+        self.query: Optional[Dict[str, Any]] = None
+        self.related_searches: Optional[List[Any]] = None
+
+    def add(self, event: StreamEvent):
+        """Folds one typed event into the accumulated response."""
+        if event.type is StreamEventType.TOKEN:
+            self._chunks.append(event.data)
+            self.token_count += 1
+        elif event.type is StreamEventType.QUERY:
+            self.query = event.data
+        elif event.type is StreamEventType.RELATED_SEARCHES:
+            self.related_searches = event.data
+
+    @property
+    def text(self) -> str:
+        """The full answer so far, joined once and cached until more tokens arrive."""
+        if len(self._chunks) > 1:
+            self._chunks[:] = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the accumulated response in the shape returned by handle_response."""
+        response_dict = {'streaming_response': self.text}
+        if self.query is not None:
+            response_dict['query'] = self.query
+        if self.related_searches is not None:
+            response_dict['relatedSearches'] = self.related_searches
         return response_dict
 
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Returns the q-th percentile (0-100) of `values` by linear interpolation, or None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+@dataclass
+class AttemptTiming:
+    """One try at opening and reading the upstream stream; times are relative to StreamMetrics.started."""
+    number: int
+    started: float
+    duration: Optional[float] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class StreamMetrics:
+    """Timings for one streamed request, measured in seconds from when the call started.
+
+    `connect_time` is only set when a new connection had to be opened, and `time_to_headers` and
+    `bytes_received` only when this call read the upstream response itself (not when it was
+    replayed from the cache or joined another call's stream).
+    """
+    model: AIModelEnum
+    chat_mode: ChatModeEnum
+    started: float = field(default_factory=time.perf_counter)
+    connect_time: Optional[float] = None
+    time_to_headers: Optional[float] = None
+    time_to_first_token: Optional[float] = None
+    duration: Optional[float] = None
+    token_count: int = 0
+    bytes_received: int = 0
+    inter_token_gaps: List[float] = field(default_factory=list)
+    cached: bool = False
+    rate_limit_wait: float = 0.0  # time spent waiting for the client's RateLimiter
+    concurrency_wait: float = 0.0  # time spent waiting for a slot from the client's AdaptiveConcurrencyLimiter
+    hedged: bool = False  # a duplicate request was sent because the first token was late
+    hedge_won: bool = False  # ...and the duplicate produced the answer
+    error: Optional[str] = None
+    timeout: Optional[str] = None  # the Timeouts limit that ended the stream, if any
+    attempts: List[AttemptTiming] = field(default_factory=list)
+    _last_token: Optional[float] = field(default=None, repr=False)
+
+    def start_attempt(self) -> AttemptTiming:
+        attempt = AttemptTiming(len(self.attempts) + 1, time.perf_counter() - self.started)
+        self.attempts.append(attempt)
+        return attempt
+
+    def end_attempt(self, attempt: AttemptTiming, error: Optional[BaseException] = None):
+        attempt.duration = time.perf_counter() - self.started - attempt.started
+        if error is not None:
+            attempt.error = type(error).__name__
+
+    def mark_headers(self):
+        self.time_to_headers = time.perf_counter() - self.started
+
+    def mark_token(self):
+        now = time.perf_counter()
+        if self._last_token is None:
+            self.time_to_first_token = now - self.started
+        else:
+            self.inter_token_gaps.append(now - self._last_token)
+        self._last_token = now
+        self.token_count += 1
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def attempt_time_to_first_token(self, attempt: AttemptTiming) -> Optional[float]:
+        """Time from the start of `attempt` to the first token, if that attempt produced one."""
+        if self.time_to_first_token is None or self.time_to_first_token < attempt.started:
+            return None
+        return self.time_to_first_token - attempt.started
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Streaming rate between the first and the last token."""
+        streaming = sum(self.inter_token_gaps)
+        return len(self.inter_token_gaps) / streaming if streaming > 0 else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the metrics as plain values, with inter-token gaps summarized."""
+        return {
+            'model': self.model.name,
+            'chat_mode': self.chat_mode.value,
+            'connect_time': self.connect_time,
+            'time_to_headers': self.time_to_headers,
+            'time_to_first_token': self.time_to_first_token,
+            'duration': self.duration,
+            'token_count': self.token_count,
+            'bytes_received': self.bytes_received,
+            'tokens_per_second': self.tokens_per_second,
+            'inter_token_gap_p50': percentile(self.inter_token_gaps, 50),
+            'inter_token_gap_max': max(self.inter_token_gaps, default=None),
+            'cached': self.cached,
+            'rate_limit_wait': self.rate_limit_wait,
+            'concurrency_wait': self.concurrency_wait,
+            'hedged': self.hedged,
+            'hedge_won': self.hedge_won,
+            'error': self.error,
+            'timeout': self.timeout,
+            'attempts': [asdict(attempt) for attempt in self.attempts],
+        }
+
+
+MetricsHook = Callable[[StreamMetrics], None]
+
+
+class LatencyRecorder:
+    """Metrics hook that keeps the most recent StreamMetrics per AIModelEnum for percentile queries."""
+
+    summary_fields = ('time_to_first_token', 'time_to_headers', 'tokens_per_second', 'duration')
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[AIModelEnum, Deque[StreamMetrics]] = {}
+
+    def __call__(self, metrics: StreamMetrics):
+        with self._lock:
+            samples = self._samples.get(metrics.model)
+            if samples is None:
+                samples = self._samples[metrics.model] = deque(maxlen=self.window)
+            samples.append(metrics)
+
+    def count(self, model: AIModelEnum) -> int:
+        """Number of recent samples kept for `model`."""
+        with self._lock:
+            return len(self._samples.get(model, ()))
+
+    def percentile(self, model: AIModelEnum, q: float, metric: str = 'time_to_first_token') -> Optional[float]:
+        """The q-th percentile of `metric` over the model's successful recent requests."""
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        return percentile([value for value in (getattr(m, metric) for m in samples if m.error is None)
+                           if value is not None], q)
+
+    def summary(self, quantiles: Iterable[float] = (50, 99)) -> Dict[str, Dict[str, Optional[float]]]:
+        """Percentiles of the main timings for every model seen, e.g. {'GPT_4O': {'time_to_first_token_p99': ...}}."""
+        with self._lock:
+            models = list(self._samples)
+        return {model.name: {f'{metric}_p{q:g}': self.percentile(model, q, metric)
+                             for metric in self.summary_fields for q in quantiles}
+                for model in models}
+
+
+class HedgePolicy:
+    """When YouChat sends a duplicate ("hedge") of a request that has not produced a token yet.
+
+    The hedge goes out once the request has waited the `percentile` of the model's recent times to
+    first token, clamped to `min_delay`..`max_delay` and refreshed every `refresh` seconds, or
+    `initial_delay` until `min_samples` streams have been seen. `model` sends the hedge to another
+    model. Whichever stream produces its first token (or finishes) first is kept and the other is
+    cancelled. `fired` and `won` count hedges sent and hedges that beat the original request.
+    """
+
+    def __init__(self, percentile: float = 95.0, min_delay: float = 0.05, max_delay: float = 10.0,
+                 initial_delay: float = 1.0, min_samples: int = 20, model: Optional[AIModelEnum] = None,
+                 recorder: Optional[LatencyRecorder] = None, refresh: float = 1.0):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.model = model
+        self.recorder = recorder or LatencyRecorder()
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._delays: Dict[AIModelEnum, Tuple[float, float]] = {}
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+
+    def delay(self, model: AIModelEnum) -> float:
+        """Seconds to wait for the first token of a request to `model` before hedging it."""
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            cached = self._delays.get(model)
+        if cached is not None and now - cached[0] < self.refresh:
+            return cached[1]
+        delay = self.initial_delay
+        if self.recorder.count(model) >= self.min_samples:
+            value = self.recorder.percentile(model, self.percentile)
+            if value is not None:
+                delay = min(max(value, self.min_delay), self.max_delay)
+        with self._lock:
+            self._delays[model] = (now, delay)
+        return delay
+
+    def record(self, metrics: StreamMetrics):
+        """Feeds a finished stream's timings into the delay estimate."""
+        self.recorder(metrics)
+
+    def count(self, fired: int = 0, won: int = 0):
+        with self._lock:
+            self.fired += fired
+            self.won += won
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Hedged requests seen, hedges sent and hedges that won."""
+        with self._lock:
+            return {'requests': self.requests, 'fired': self.fired, 'won': self.won}
+
+
+def normalize_query(query: str) -> str:
+    """Default cache key normalizer: collapses whitespace and folds case."""
+    return ' '.join(query.split()).casefold()
+
+
+CacheKey = Tuple[AIModelEnum, ChatModeEnum, str, FrozenSet[str]]
+
+
+def _events_size(events: Tuple[StreamEvent, ...]) -> int:
+    # Approximate memory footprint: token text plus the repr of any structured payload
+    return sum(len(event.data) if isinstance(event.data, str) else len(repr(event.data)) for event in events)
+
+
+class ResponseCacheBackend(ABC):
+    """Abstract base class for stores of complete streamed responses used by YouChat."""
+
+    def __init__(self, normalizer: Callable[[str], str] = normalize_query):
+        self.normalizer = normalizer
+
+    def key(self, model: AIModelEnum, chat_mode: ChatModeEnum, query: str, events: AbstractSet[str]) -> CacheKey:
+        """Builds the cache key; the event subscription is part of it because it changes what is recorded."""
+        return model, chat_mode, self.normalizer(query), frozenset(events)
+
+    @abstractmethod
+    def get(self, key: CacheKey) -> Optional[Tuple[StreamEvent, ...]]:
+        """Returns the recorded events for `key`, or None on a miss."""
+        pass
+
+    @abstractmethod
+    def set(self, key: CacheKey, events: Iterable[StreamEvent]):
+        """Stores the events of a finished stream."""
+        pass
+
+    async def get_async(self, key: CacheKey) -> Optional[Tuple[StreamEvent, ...]]:
+        """get() for AsyncYouChat; backends that wait on I/O override it to keep the event loop free."""
+        return self.get(key)
+
+    async def set_async(self, key: CacheKey, events: Iterable[StreamEvent]):
+        """set() for AsyncYouChat; backends that wait on I/O override it to keep the event loop free."""
+        self.set(key, events)
+
+    @abstractmethod
+    def invalidate(self, query: Optional[str] = None, model: Optional[AIModelEnum] = None,
+                   chat_mode: Optional[ChatModeEnum] = None) -> int:
+        """Drops matching entries and returns how many were removed."""
+        pass
+
+    def clear(self):
+        """Removes every entry."""
+        self.invalidate()
+
+
+class ResponseCache(ResponseCacheBackend):
+    """Thread-safe in-memory LRU cache of complete streamed responses.
+
+    Entries are the recorded typed events of a finished stream, so a hit can be replayed through
+    stream() exactly as it arrived. Entries expire after `ttl` seconds and the least recently used
+    ones are evicted once `max_entries` or `max_bytes` is exceeded.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None, ttl: Optional[float] = 300.0,
+                 normalizer: Callable[[str], str] = normalize_query):
+        super().__init__(normalizer)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: 'OrderedDict[CacheKey, Tuple[float, int, Tuple[StreamEvent, ...]]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: CacheKey) -> Optional[Tuple[StreamEvent, ...]]:
+        """Returns the recorded events for `key`, or None on a miss or an expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key: CacheKey, events: Iterable[StreamEvent]):
+        """Stores the events of a finished stream, evicting least recently used entries as needed."""
+        events = tuple(events)
+        size = _events_size(events)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float('inf')
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, size, events)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, query: Optional[str] = None, model: Optional[AIModelEnum] = None,
+                   chat_mode: Optional[ChatModeEnum] = None) -> int:
+        """Drops every entry matching the given query, model and chat mode; no filters clears the cache."""
+        normalized = self.normalizer(query) if query is not None else None
+        with self._lock:
+            keys = [key for key in self._entries
+                    if (model is None or key[0] is model) and (chat_mode is None or key[1] is chat_mode)
+                    and (normalized is None or key[2] == normalized)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def _remove(self, key: CacheKey):
+        self._bytes -= self._entries.pop(key)[1]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Hit, miss, eviction and expiration counters plus the current size."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'entries': len(self._entries), 'bytes': self._bytes}
+
+
+class _SQLiteConnections:
+    """One connection per thread and per process to a SQLite database in WAL mode.
+
+    sqlite3 connections must not be shared between threads, and one inherited through fork() must
+    be neither used nor closed by the child (closing it could release locks or clean up WAL files
+    the parent still relies on). A connection is therefore only handed back to the thread and the
+    process that opened it; inherited ones are kept referenced and never touched again.
+    """
+
+    def __init__(self, path: str, timeout: float):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._inherited: List[sqlite3.Connection] = []
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        pid = os.getpid()
+        if connection is not None:
+            if self._local.pid == pid:
+                return connection
+            self._inherited.append(connection)
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        self._local.connection, self._local.pid = connection, pid
+        return connection
+
+    def close(self):
+        """Closes the calling thread's connection if this process opened it."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+        self._local.connection = None
+
+
+class SQLiteResponseCache(ResponseCacheBackend):
+    """Persistent response cache stored in a SQLite database in WAL mode.
+
+    Safe to share between threads and between worker processes on one host, including ones forked
+    after the cache was created: every thread of every process gets its own connection, writes run in IMMEDIATE transactions and readers never block writers.
+    Entries expire after `ttl` seconds, and once the database grows past `max_bytes` the least
+    recently used entries are evicted. Only token, query and related searches events are
+    persisted; streams carrying other subscribed events are not cached.
+    """
+
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS responses ('
+        'key TEXT PRIMARY KEY, model TEXT NOT NULL, chat_mode TEXT NOT NULL, normalized_query TEXT NOT NULL, '
+        'streaming_response TEXT NOT NULL, query TEXT, related_searches TEXT, token_lengths TEXT NOT NULL, '
+        'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)',
+        'CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)',
+    )
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None, ttl: Optional[float] = 86400.0,
+                 normalizer: Callable[[str], str] = normalize_query, timeout: float = 30.0):
+        super().__init__(normalizer)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timeout = timeout
+        self._connections = _SQLiteConnections(path, timeout)
+        self._counter_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        connection = self._connection()
+        for statement in self._SCHEMA:
+            connection.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    @staticmethod
+    def _row_key(key: CacheKey) -> str:
+        model, chat_mode, normalized_query, events = key
+        raw = '\0'.join((model.value, chat_mode.value, ','.join(sorted(events)), normalized_query))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, key: CacheKey) -> Optional[Tuple[StreamEvent, ...]]:
+        """Returns the persisted events for `key`, or None on a miss or an expired entry."""
+        connection = self._connection()
+        row_key = self._row_key(key)
+        now = time.time()
+        row = connection.execute(
+            'SELECT streaming_response, query, related_searches, token_lengths, expires_at FROM responses WHERE key = ?',
+            (row_key,)
+        ).fetchone()
+        if row is not None and row[4] < now:
+            connection.execute('DELETE FROM responses WHERE key = ? AND expires_at < ?', (row_key, now))
+            self._count('expirations')
+            row = None
+        if row is None:
+            self._count('misses')
+            return None
+        connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, row_key))
+        self._count('hits')
+
+        streaming_response, query, related_searches, token_lengths, _ = row
+        events = []
+        if query is not None:
+            events.append(StreamEvent(StreamEventType.QUERY, json.loads(query)))
+        offset = 0
+        for length in json.loads(token_lengths):
+            events.append(StreamEvent(StreamEventType.TOKEN, streaming_response[offset:offset + length]))
+            offset += length
+        if related_searches is not None:
+            events.append(StreamEvent(StreamEventType.RELATED_SEARCHES, json.loads(related_searches)))
+        return tuple(events)
+
+    def set(self, key: CacheKey, events: Iterable[StreamEvent]):
+        """Persists the events of a finished stream and evicts old entries if the database is too big."""
+        accumulator = ResponseAccumulator()
+        token_lengths = []
+        for event in events:
+            if event.type is StreamEventType.MESSAGE:
+                return
+            accumulator.add(event)
+            if event.type is StreamEventType.TOKEN:
+                token_lengths.append(len(event.data))
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else float('inf')
+        model, chat_mode, normalized_query, _ = key
+        row = (
+            self._row_key(key), model.value, chat_mode.value, normalized_query, accumulator.text,
+            json.dumps(accumulator.query) if accumulator.query is not None else None,
+            json.dumps(accumulator.related_searches) if accumulator.related_searches is not None else None,
+            json.dumps(token_lengths), expires_at, now,
+        )
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            expired = connection.execute('DELETE FROM responses WHERE expires_at < ?', (now,)).rowcount
+            evicted = self._evict(connection)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self._count('expirations', expired)
+        self._count('evictions', evicted)
+
+    async def get_async(self, key: CacheKey) -> Optional[Tuple[StreamEvent, ...]]:
+        """get() in the loop's default executor, so a busy database does not stall other streams."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def set_async(self, key: CacheKey, events: Iterable[StreamEvent]):
+        """set() in the loop's default executor; writes may wait up to `timeout` for other processes."""
+        await asyncio.get_running_loop().run_in_executor(None, self.set, key, tuple(events))
+
+    def _evict(self, connection: sqlite3.Connection, batch: int = 16) -> int:
+        # Live size ignores free pages, so deleted rows count as reclaimed without a VACUUM
+        if self.max_bytes is None:
+            return 0
+        evicted = 0
+        while self._database_bytes(connection) > self.max_bytes:
+            deleted = connection.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)', (batch,)
+            ).rowcount
+            if not deleted:
+                break
+            evicted += deleted
+        return evicted
+
+    @staticmethod
+    def _database_bytes(connection: sqlite3.Connection) -> int:
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = connection.execute('PRAGMA freelist_count').fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def invalidate(self, query: Optional[str] = None, model: Optional[AIModelEnum] = None,
+                   chat_mode: Optional[ChatModeEnum] = None) -> int:
+        """Drops every entry matching the given query, model and chat mode; no filters clears the cache."""
+        clauses, params = [], []
+        if query is not None:
+            clauses.append('normalized_query = ?')
+            params.append(self.normalizer(query))
+        if model is not None:
+            clauses.append('model = ?')
+            params.append(model.value)
+        if chat_mode is not None:
+            clauses.append('chat_mode = ?')
+            params.append(chat_mode.value)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        return self._connection().execute(f'DELETE FROM responses{where}', params).rowcount
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """This process's hit, miss, eviction and expiration counters plus the database size."""
+        connection = self._connection()
+        with self._counter_lock:
+            counters = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                        'expirations': self.expirations}
+        counters['entries'] = connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        counters['bytes'] = self._database_bytes(connection)
+        return counters
+
+    def close(self):
+        """Closes this thread's database connection."""
+        self._connections.close()
+
+
+def record_stream(events: Iterable[StreamEvent], cache: ResponseCacheBackend, key: CacheKey) -> Iterator[StreamEvent]:
+    """Passes events through and stores them in `cache` once the stream reaches DONE."""
+    recorded = []
+    for event in events:
+        if event.type is StreamEventType.DONE:
+            cache.set(key, recorded)
+        else:
+            recorded.append(event)
+        yield event
+
+
+def replay_events(events: Iterable[StreamEvent]) -> Iterator[StreamEvent]:
+    """Yields cached events followed by DONE, exactly like a live stream."""
+    yield from events
+    yield StreamEvent(StreamEventType.DONE)
+
+
+class _Flight:
+    """Shared state of one coalesced upstream stream."""
+
+    def __init__(self, start: Callable[[], Any], condition: Any):
+        self.start = start
+        self.condition = condition
+        self.upstream = None
+        self.events: List[StreamEvent] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.pumping = False
+        # AsyncSingleFlight only: the task currently reading the next event from upstream
+        self.pump: Optional[asyncio.Task] = None
+        self.readers = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent identical streams onto a single upstream request for threaded clients.
+
+    The first caller for a key starts the upstream stream; callers arriving while it is still
+    running join it instead. Every caller receives the full event sequence from the beginning.
+    Whichever reader needs the next event pulls it from upstream, so no extra threads are used
+    and the stream keeps going if the first caller stops reading early.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Any, _Flight] = {}
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    def stream(self, key: Any, start: Callable[[], Iterator[StreamEvent]]) -> Iterator[StreamEvent]:
+        """Yields the events of the stream for `key`, calling `start` only if none is in flight."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(start, threading.Condition())
+                self.upstream_calls += 1
+            else:
+                self.coalesced += 1
+            flight.readers += 1
+        return self._read(key, flight)
+
+    def _read(self, key: Any, flight: _Flight) -> Iterator[StreamEvent]:
+        index = 0
+        condition = flight.condition
+        try:
+            while True:
+                with condition:
+                    while index >= len(flight.events) and not flight.done and flight.pumping:
+                        condition.wait()
+                    if index < len(flight.events):
+                        event = flight.events[index]
+                    elif flight.done:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    else:
+                        # Nobody is reading from upstream right now, so this reader does it
+                        flight.pumping = True
+                        event = None
+                if event is None:
+                    self._pump(key, flight)
+                else:
+                    index += 1
+                    yield event
+        finally:
+            self._leave(key, flight)
+
+    def _pump(self, key: Any, flight: _Flight):
+        event, done, error = None, False, None
+        try:
+            if flight.upstream is None:
+                flight.upstream = iter(flight.start())
+            event = next(flight.upstream)
+        except StopIteration:
+            done = True
+        except Exception as e:
+            done, error = True, e
+        finally:
+            with flight.condition:
+                if event is not None:
+                    flight.events.append(event)
+                if done:
+                    flight.done, flight.error = True, error
+                flight.pumping = False
+                flight.condition.notify_all()
+        if done:
+            self._forget(key, flight)
+
+    def _leave(self, key: Any, flight: _Flight):
+        with self._lock:
+            flight.readers -= 1
+            abandoned = flight.readers == 0 and not flight.done
+            if abandoned and self._flights.get(key) is flight:
+                del self._flights[key]
+        if abandoned and hasattr(flight.upstream, 'close'):
+            # Every reader gave up, so release the upstream connection
+            flight.upstream.close()
+
+    def _forget(self, key: Any, flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Upstream requests started, requests served by joining one, and streams currently in flight."""
+        with self._lock:
+            return {'upstream_calls': self.upstream_calls, 'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+
+class AsyncSingleFlight:
+    """asyncio counterpart of SingleFlight for AsyncYouChat; use one instance per event loop.
+
+    Each upstream read runs in its own task that readers await through asyncio.shield, so
+    cancelling the caller that happened to pull the next event does not end the shared stream.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Any, _Flight] = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    def stream(self, key: Any, start: Callable[[], AsyncIterator[StreamEvent]]) -> AsyncIterator[StreamEvent]:
+        """Yields the events of the stream for `key`, calling `start` only if none is in flight."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight(start, asyncio.Condition())
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+        flight.readers += 1
+        return self._read(key, flight)
+
+    async def _read(self, key: Any, flight: _Flight) -> AsyncIterator[StreamEvent]:
+        index = 0
+        condition = flight.condition
+        try:
+            while True:
+                async with condition:
+                    while index >= len(flight.events) and not flight.done and flight.pumping:
+                        await condition.wait()
+                    if index < len(flight.events):
+                        event = flight.events[index]
+                    elif flight.done:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    else:
+                        flight.pumping = True
+                        event = None
+                if event is None:
+                    flight.pump = asyncio.ensure_future(self._pump(key, flight))
+                    await asyncio.shield(flight.pump)
+                else:
+                    index += 1
+                    yield event
+        finally:
+            flight.readers -= 1
+            if flight.readers == 0 and not flight.done:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if flight.pump is not None and not flight.pump.done():
+                    # Every reader gave up; the generator cannot be closed while a read is running
+                    flight.pump.cancel()
+                    await asyncio.wait([flight.pump])
+                if flight.upstream is not None:
+                    await flight.upstream.aclose()
+
+    async def _pump(self, key: Any, flight: _Flight):
+        event, done, error = None, False, None
+        try:
+            if flight.upstream is None:
+                flight.upstream = flight.start()
+            event = await flight.upstream.__anext__()
+        except StopAsyncIteration:
+            done = True
+        except Exception as e:
+            done, error = True, e
+        except BaseException as e:
+            # Cancelled or interrupted mid-read: the upstream generator is finalized, so readers still
+            # waiting must see an error rather than mistake the end of the generator for the answer's end
+            done, error = True, StreamInterruptedError("The shared stream was interrupted before it finished.")
+            error.__cause__ = e
+            raise
+        finally:
+            async with flight.condition:
+                if event is not None:
+                    flight.events.append(event)
+                if done:
+                    flight.done, flight.error = True, error
+                flight.pumping = False
+                flight.condition.notify_all()
+        if done and self._flights.get(key) is flight:
+            del self._flights[key]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Upstream requests started, requests served by joining one, and streams currently in flight."""
+        return {'upstream_calls': self.upstream_calls, 'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+
+_CONNECT_TIMEOUT_ERRORS: Tuple[type, ...] = (requests.ConnectTimeout,)
+if aiohttp is not None and hasattr(aiohttp, 'ConnectionTimeoutError'):
+    _CONNECT_TIMEOUT_ERRORS += (aiohttp.ConnectionTimeoutError,)
+
+
+class StreamDeadline:
+    """Tracks the timeouts of one call and aborts its open response as soon as one of them passes.
+
+    Nothing is scheduled per token: the watchdog only wakes at the earliest pending deadline and,
+    if tokens moved it, re-arms for the new one.
+    """
+
+    def __init__(self, timeouts: Timeouts):
+        self.timeouts = timeouts
+        self.started = time.monotonic()
+        self.last_token: Optional[float] = None
+        self.tripped: Optional[str] = None
+        self.cancelled = False
+        self.done = False
+        self._abort: Optional[Callable[[], None]] = None
+        self._arm: Optional[Callable[[Optional[float]], None]] = None
+        self.scheduled: Optional[float] = None  # when the pending check runs
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def token(self):
+        first = self.last_token is None
+        self.last_token = time.monotonic()
+        if first and self._arm is not None:
+            # Only the first token can bring the next check forward, when idle is shorter than what is left
+            when = self.next_check()
+            if when is not None and (self.scheduled is None or when < self.scheduled):
+                self._arm(when)
+
+    def expired(self, now: float) -> Optional[str]:
+        """The name of the first limit that has passed at `now`, if any."""
+        timeouts = self.timeouts
+        if timeouts.total is not None and now - self.started >= timeouts.total:
+            return 'total'
+        if self.last_token is None:
+            if timeouts.first_token is not None and now - self.started >= timeouts.first_token:
+                return 'first_token'
+        elif timeouts.idle is not None and now - self.last_token >= timeouts.idle:
+            return 'idle'
+        return None
+
+    def next_check(self) -> Optional[float]:
+        """Monotonic time at which the next limit could pass."""
+        timeouts = self.timeouts
+        candidates = []
+        if timeouts.total is not None:
+            candidates.append(self.started + timeouts.total)
+        if self.last_token is None:
+            if timeouts.first_token is not None:
+                candidates.append(self.started + timeouts.first_token)
+        elif timeouts.idle is not None:
+            candidates.append(self.last_token + timeouts.idle)
+        return min(candidates, default=None)
+
+    def header_timeout(self) -> Optional[float]:
+        """Seconds the response headers may take before the first_token or total limit passes."""
+        when = self.next_check()
+        return None if when is None else max(when - time.monotonic(), 0.0)
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the overall deadline."""
+        if self.timeouts.total is None:
+            return None
+        return max(self.started + self.timeouts.total - time.monotonic(), 0.0)
+
+    def check(self) -> Optional[float]:
+        # Trips and aborts when a limit has passed; otherwise returns when to check again
+        if self.done or self.tripped is not None:
+            return None
+        limit = self.expired(time.monotonic())
+        if limit is None:
+            return self.next_check()
+        self.tripped = limit
+        if self._abort is not None:
+            self._abort()
+        return None
+
+    def attach(self, abort: Callable[[], None]):
+        """Sets how to cancel the attempt in progress; aborts right away if a limit already passed."""
+        self._abort = abort
+        if self.tripped is not None or self.cancelled:
+            abort()
+
+    def detach(self):
+        self._abort = None
+
+    def cancel(self):
+        """Stops the call without it counting as a timeout, e.g. when a hedged request lost the race."""
+        self.cancelled = True
+        abort = self._abort
+        if abort is not None:
+            abort()
+
+    def watch(self):
+        """Has the shared watchdog thread enforce this deadline."""
+        def arm(when: Optional[float]):
+            self.scheduled = when
+            _watchdog.watch(self, when)
+
+        self._arm = arm
+        arm(self.next_check())
+
+    def watch_async(self):
+        """Enforces this deadline with timers on the running event loop."""
+        loop = asyncio.get_running_loop()
+
+        def arm(when: Optional[float]):
+            self.scheduled = when
+            if self._handle is not None:
+                self._handle.cancel()
+            if when is not None:
+                self._handle = loop.call_later(max(when - time.monotonic(), 0.0), fire)
+
+        def fire():
+            arm(self.check())
+
+        self._arm = arm
+        arm(self.next_check())
+
+    def close(self):
+        self.done = True
+        self._abort = None
+        self._arm = None
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def timeout_error(self, error: Optional[BaseException] = None) -> Optional['StreamTimeoutError']:
+        """The StreamTimeoutError to report for `error`, or None when it was not caused by a timeout."""
+        if isinstance(error, StreamTimeoutError):
+            return error
+        elapsed = time.monotonic() - self.started
+        if self.tripped is None:
+            if isinstance(error, _CONNECT_TIMEOUT_ERRORS):
+                # Not sticky: a retry gets a fresh connect timeout
+                return StreamTimeoutError('connect', elapsed)
+            # The socket read timeout is only a backstop, so any failure after a limit passed is that limit
+            self.tripped = self.expired(time.monotonic())
+            if self.tripped is None:
+                return None
+        return StreamTimeoutError(self.tripped, elapsed)
+
+
+class _Watchdog:
+    """Daemon thread that checks StreamDeadlines when they come due."""
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, StreamDeadline]] = []
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, deadline: StreamDeadline, when: Optional[float]):
+        if when is None:
+            return
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='youchat-watchdog', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                when, _, deadline = heapq.heappop(self._heap)
+            if when != deadline.scheduled:
+                continue  # superseded by an earlier check
+            when = deadline.check()
+            deadline.scheduled = when
+            self.watch(deadline, when)
+
+
+_watchdog = _Watchdog()
+
+
+def _response_socket(response: requests.Response) -> Optional[socket.socket]:
+    connection = getattr(response.raw, 'connection', None) or getattr(response.raw, '_connection', None)
+    return getattr(connection, 'sock', None)
+
+
+def _abort_response(response: requests.Response):
+    # Shutting the socket down wakes a read blocked in another thread; close() alone does not
+    sock = _response_socket(response)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.raw.close()
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """A token bucket: `rate` requests per second on average, with bursts of up to `burst` requests."""
+    rate: float
+    burst: float = 1.0
+
+    def __post_init__(self):
+        if self.rate <= 0 or self.burst < 1:
+            raise ValueError("RateLimit needs a positive rate and a burst of at least 1.")
+
+    @property
+    def interval(self) -> float:
+        return 1.0 / self.rate
+
+    @property
+    def tolerance(self) -> float:
+        return (self.burst - 1.0) / self.rate
+
+
+class RateLimiter:
+    """Token buckets for a global request rate and per-model rates, consulted before every upstream request.
+
+    Each bucket is stored as a single theoretical arrival time (GCRA), so one request updates the
+    global and the model bucket in one step. Without `path` the buckets are shared by the threads of
+    this process; with `path` they live in a SQLite database that every process on the host using the
+    same path shares (forked workers included), updated in IMMEDIATE transactions. `on_limit` chooses what acquire() does when a
+    request may not go yet: 'wait' sleeps until it may (at most `max_wait` seconds), 'fail' raises
+    RateLimitExceeded at once. estimate() returns the queue time without taking capacity.
+    """
+
+    _SCHEMA = 'CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tat REAL NOT NULL)'
+
+    def __init__(self, global_limit: Optional[RateLimit] = None,
+                 model_limits: Optional[Dict[AIModelEnum, RateLimit]] = None,
+                 default_model_limit: Optional[RateLimit] = None, path: Optional[str] = None,
+                 on_limit: str = 'wait', max_wait: Optional[float] = None, timeout: float = 30.0):
+        if on_limit not in ('wait', 'fail'):
+            raise ValueError("on_limit must be 'wait' or 'fail'.")
+        self.global_limit = global_limit
+        self.model_limits = dict(model_limits or {})
+        self.default_model_limit = default_model_limit
+        self.path = path
+        self.on_limit = on_limit
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._connections = _SQLiteConnections(path, timeout) if path is not None else None
+        self._tats: Dict[str, float] = {}
+        self.acquired = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.waited = 0.0
+        if path is not None:
+            self._connection().execute(self._SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def _buckets(self, model: AIModelEnum) -> List[Tuple[str, RateLimit]]:
+        buckets = []
+        if self.global_limit is not None:
+            buckets.append(('*', self.global_limit))
+        model_limit = self.model_limits.get(model, self.default_model_limit)
+        if model_limit is not None:
+            buckets.append((model.name, model_limit))
+        return buckets
+
+    @staticmethod
+    def _schedule(buckets: List[Tuple[str, RateLimit]], tats: Dict[str, float], now: float) -> float:
+        # The earliest time every bucket admits one more request
+        start = now
+        for key, limit in buckets:
+            start = max(start, tats.get(key, now) - limit.tolerance)
+        return start
+
+    def _reserve(self, model: AIModelEnum, max_wait: Optional[float], commit: bool = True) -> float:
+        # Returns the wait before the request may go; capacity is only taken when commit is set
+        # and the wait is within max_wait
+        buckets = self._buckets(model)
+        if not buckets:
+            return 0.0
+        if self.path is None:
+            with self._lock:
+                now = time.time()
+                wait = self._schedule(buckets, self._tats, now) - now
+                if commit and (max_wait is None or wait <= max_wait):
+                    for key, limit in buckets:
+                        self._tats[key] = max(self._tats.get(key, now), now + wait) + limit.interval
+                return wait
+        connection = self._connection()
+        keys = [key for key, _ in buckets]
+        connection.execute('BEGIN IMMEDIATE' if commit else 'BEGIN')
+        try:
+            rows = connection.execute(
+                f"SELECT key, tat FROM buckets WHERE key IN ({','.join('?' * len(keys))})", keys).fetchall()
+            tats = dict(rows)
+            now = time.time()
+            wait = self._schedule(buckets, tats, now) - now
+            if commit and (max_wait is None or wait <= max_wait):
+                connection.executemany('INSERT OR REPLACE INTO buckets (key, tat) VALUES (?, ?)', [
+                    (key, max(tats.get(key, now), now + wait) + limit.interval) for key, limit in buckets
+                ])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def estimate(self, model: AIModelEnum) -> float:
+        """Seconds a request for `model` would have to wait right now; takes no capacity."""
+        return max(self._reserve(model, None, commit=False), 0.0)
+
+    def try_acquire(self, model: AIModelEnum) -> bool:
+        """Takes capacity for one request if it may go right away."""
+        allowed = self._reserve(model, 0.0) <= 0.0
+        with self._lock:
+            if allowed:
+                self.acquired += 1
+            else:
+                self.rejected += 1
+        return allowed
+
+    def reserve(self, model: AIModelEnum, max_wait: Optional[float] = None) -> float:
+        """Takes capacity for one request and returns how long the caller must wait before sending it.
+
+        Raises RateLimitExceeded, taking nothing, when `on_limit` is 'fail' and the request cannot go
+        now, or when the wait would exceed `max_wait` (default: the limiter's max_wait).
+        """
+        if self.on_limit == 'fail':
+            max_wait = 0.0
+        elif max_wait is None:
+            max_wait = self.max_wait
+        elif self.max_wait is not None:
+            max_wait = min(max_wait, self.max_wait)
+        wait = self._reserve(model, max_wait)
+        with self._lock:
+            if max_wait is not None and wait > max_wait:
+                self.rejected += 1
+                raise RateLimitExceeded(model, wait)
+            self.acquired += 1
+            if wait > 0:
+                self.delayed += 1
+                self.waited += wait
+        return max(wait, 0.0)
+
+    def acquire(self, model: AIModelEnum, max_wait: Optional[float] = None) -> float:
+        """Blocks until a request for `model` may be sent and returns the seconds waited."""
+        wait = self.reserve(model, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, model: AIModelEnum, max_wait: Optional[float] = None) -> float:
+        """acquire() for the event loop: waits with asyncio.sleep instead of blocking.
+
+        With `path` set the SQLite transaction, which may wait on other processes' locks, runs in
+        the loop's default executor.
+        """
+        if self.path is None:
+            wait = self.reserve(model, max_wait)
+        else:
+            wait = await asyncio.get_running_loop().run_in_executor(None, self.reserve, model, max_wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Requests let through, how many of them waited and for how long in total, and requests refused."""
+        with self._lock:
+            return {'acquired': self.acquired, 'delayed': self.delayed, 'rejected': self.rejected, 'waited': self.waited}
+
+    def reset(self):
+        """Forgets all bucket state, including the shared state when `path` is set."""
+        with self._lock:
+            self._tats.clear()
+        if self.path is not None:
+            self._connection().execute('DELETE FROM buckets')
+
+    def close(self):
+        if self._connections is not None:
+            self._connections.close()
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """Whether `error` signals that the server or the network is saturated (408, 429, 5xx, timeouts, broken connections)."""
+    if isinstance(error, HTTPStatusError):
+        return error.status in (408, 429) or error.status >= 500
+    return isinstance(error, (StreamTimeoutError,) + _RETRYABLE_ERRORS)
+
+
+class _SlotWaiter:
+    """A caller queued for a concurrency slot, woken through a threading.Event or an asyncio future."""
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.granted = False
+        self.abandoned = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class ConcurrencySlot:
+    """One admitted request; release it exactly once, with its latency or error as feedback."""
+
+    __slots__ = ('limiter', 'started', 'released')
+
+    def __init__(self, limiter: 'AdaptiveConcurrencyLimiter', started: float):
+        self.limiter = limiter
+        self.started = started
+        self.released = False
+
+    def release(self, latency: Optional[float] = None, error: Optional[BaseException] = None):
+        """Frees the slot; later calls do nothing. Without latency or error the limit is left alone."""
+        if not self.released:
+            self.released = True
+            self.limiter._release(self, latency, error)
+
+
+class AdaptiveConcurrencyLimiter:
+    """In-flight request limit adjusted by additive increase / multiplicative decrease (AIMD).
+
+    Each upstream attempt holds a slot while it streams and reports its time to first token when
+    it finishes. While the limit is fully used, every fast success raises it by `increase / limit`,
+    i.e. by about `increase` per limit's worth of requests. An overload error (429, 5xx, timeout,
+    connection failure) multiplies it by `backoff`, at most once per generation of requests so a
+    burst of failures only cuts it once. Time to first token depends on the query and chat mode as
+    much as on load, so it only counts as overload when `latency_target` is set and the smoothed
+    value exceeds it. Waiters are served in FIFO order, from threads and event loops alike.
+    `limit`, `stats` and `history` (timestamped limit changes) expose its state.
+    """
+
+    def __init__(self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64, increase: float = 1.0,
+                 backoff: float = 0.5, latency_target: Optional[float] = None, smoothing: float = 0.2,
+                 history: int = 256):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("AdaptiveConcurrencyLimiter needs 1 <= min_limit <= initial_limit <= max_limit.")
+        if not 0 < backoff < 1:
+            raise ValueError("backoff must be between 0 and 1.")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.smoothing = smoothing
+        self._smoothed: Optional[float] = None
+        self._lock = threading.Lock()
+        self._limit = float(initial_limit)
+        self._waiters: Deque[_SlotWaiter] = deque()
+        self._last_decrease = float('-inf')
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self.history: Deque[Tuple[float, int]] = deque([(time.time(), initial_limit)], maxlen=history)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _take(self) -> Optional[ConcurrencySlot]:
+        # Called with the lock held
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return ConcurrencySlot(self, time.perf_counter())
+        return None
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[ConcurrencySlot]:
+        """Waits for a slot, up to `timeout` seconds; returns None when none freed up in time."""
+        with self._lock:
+            slot = self._take()
+            if slot is not None:
+                return slot
+            waiter = _SlotWaiter()
+            self._waiters.append(waiter)
+        waiter.event.wait(timeout)
+        return self._claim(waiter)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> Optional[ConcurrencySlot]:
+        """acquire() for the event loop: waits without blocking other tasks."""
+        with self._lock:
+            slot = self._take()
+            if slot is not None:
+                return slot
+            waiter = _SlotWaiter(asyncio.get_running_loop())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            slot = self._claim(waiter)
+            if slot is not None:
+                slot.release()
+            raise
+        return self._claim(waiter)
+
+    def _claim(self, waiter: _SlotWaiter) -> Optional[ConcurrencySlot]:
+        # Turns a finished wait into a slot, or withdraws the waiter if it was never granted one
+        with self._lock:
+            if waiter.granted:
+                return ConcurrencySlot(self, time.perf_counter())
+            waiter.abandoned = True
+            return None
+
+    def _too_slow(self, latency: float) -> bool:
+        # Judged on an exponentially weighted average so one slow stream does not cut the limit
+        if self._smoothed is None:
+            self._smoothed = latency
+        else:
+            self._smoothed += self.smoothing * (latency - self._smoothed)
+        return self.latency_target is not None and self._smoothed > self.latency_target
+
+    def _set_limit(self, limit: float):
+        previous = self.limit
+        self._limit = min(max(limit, float(self.min_limit)), float(self.max_limit))
+        if self.limit != previous:
+            self.history.append((time.time(), self.limit))
+
+    def _release(self, slot: ConcurrencySlot, latency: Optional[float], error: Optional[BaseException]):
+        with self._lock:
+            if (error is not None and is_overload_error(error)) or (latency is not None and self._too_slow(latency)):
+                # Requests that started before the last cut saw the old limit; they must not cut it again
+                if slot.started > self._last_decrease:
+                    self._last_decrease = time.perf_counter()
+                    self.decreases += 1
+                    self._set_limit(self._limit * self.backoff)
+            elif latency is not None and error is None and self.in_flight >= self.limit:
+                self.increases += 1
+                self._set_limit(self._limit + self.increase / self._limit)
+            self.in_flight -= 1
+            while self._waiters and self.in_flight < self.limit:
+                waiter = self._waiters.popleft()
+                if not waiter.abandoned:
+                    self.in_flight += 1
+                    waiter.grant()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Current limit, requests in flight and waiting, limit changes so far and the smoothed latency."""
+        with self._lock:
+            return {
+                'limit': self.limit, 'in_flight': self.in_flight,
+                'waiting': sum(not waiter.abandoned for waiter in self._waiters),
+                'increases': self.increases, 'decreases': self.decreases,
+                'smoothed_latency': self._smoothed,
+            }
+
+
+class CircuitState(Enum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+
+class CircuitPermit:
+    """Leave to make one upstream call through a CircuitBreaker; release it once with the call's outcome."""
+
+    __slots__ = ('breaker', 'trial', 'released')
+
+    def __init__(self, breaker: 'CircuitBreaker', trial: bool):
+        self.breaker = breaker
+        self.trial = trial
+        self.released = False
+
+    def release(self, latency: Optional[float] = None, error: Optional[BaseException] = None):
+        """Reports the call; later calls do nothing. Without latency or error it counts as neither outcome."""
+        if not self.released:
+            self.released = True
+            self.breaker._release(self, latency, error)
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker for one model, tripped by its failure rate over a sliding window.
+
+    A call fails on an overload error or, with `slow_call_threshold`, when its time to first token
+    exceeds that many seconds. Once the last `window` seconds hold at least `min_calls` calls and a
+    `failure_rate` share of them failed, the breaker opens and refuses calls for `open_duration`
+    seconds. It then lets `half_open_calls` trial calls through: it closes when they all succeed and
+    opens again on the first failure. Refusing a call only takes a lock and a clock read.
+    """
+
+    def __init__(self, failure_rate: float = 0.5, min_calls: int = 10, window: float = 30.0,
+                 slow_call_threshold: Optional[float] = None, open_duration: float = 30.0,
+                 half_open_calls: int = 1, buckets: int = 10):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call_threshold = slow_call_threshold
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self._bucket_width = window / buckets
+        self._buckets: Deque[List[float]] = deque()  # [start, calls, failures]
+        self._lock = threading.Lock()
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_successes = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def _current_state(self, now: float) -> CircuitState:
+        # Called with the lock held; an open breaker turns half-open once open_duration has passed
+        if self._state is CircuitState.OPEN and now - self._opened_at >= self.open_duration:
+            self._state = CircuitState.HALF_OPEN
+            self._trials = self._trial_successes = 0
+        return self._state
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    @property
+    def retry_after(self) -> float:
+        """Seconds until an open breaker lets trial calls through."""
+        with self._lock:
+            if self._current_state(time.monotonic()) is not CircuitState.OPEN:
+                return 0.0
+            return max(self._opened_at + self.open_duration - time.monotonic(), 0.0)
+
+    def available(self) -> bool:
+        """Whether acquire() would currently let a call through; takes nothing."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return state is CircuitState.CLOSED or (state is CircuitState.HALF_OPEN and self._trials < self.half_open_calls)
+
+    def acquire(self) -> Optional[CircuitPermit]:
+        """Returns a permit for one call, or None when the breaker refuses it."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state is CircuitState.CLOSED:
+                return CircuitPermit(self, False)
+            if state is CircuitState.HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return CircuitPermit(self, True)
+            self.rejected += 1
+            return None
+
+    def _open(self, now: float):
+        self._state = CircuitState.OPEN
+        self._opened_at = now
+        self._buckets.clear()
+        self.opened += 1
+
+    def _release(self, permit: CircuitPermit, latency: Optional[float], error: Optional[BaseException]):
+        if error is not None:
+            failed: Optional[bool] = True if is_overload_error(error) else None
+        elif latency is not None:
+            failed = self.slow_call_threshold is not None and latency > self.slow_call_threshold
+        else:
+            failed = None
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if permit.trial:
+                if state is not CircuitState.HALF_OPEN:
+                    return
+                if failed is None:
+                    self._trials -= 1
+                elif failed:
+                    self._open(now)
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= self.half_open_calls:
+                        self._state = CircuitState.CLOSED
+                return
+            if failed is None or state is not CircuitState.CLOSED:
+                return
+            start = now - now % self._bucket_width
+            if not self._buckets or self._buckets[-1][0] != start:
+                self._buckets.append([start, 0, 0])
+            while self._buckets[0][0] <= now - self.window:
+                self._buckets.popleft()
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            bucket[2] += failed
+            if failed:
+                calls = sum(b[1] for b in self._buckets)
+                failures = sum(b[2] for b in self._buckets)
+                if calls >= self.min_calls and failures >= self.failure_rate * calls:
+                    self._open(now)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """State, calls and failures in the current window, times opened and calls refused."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return {
+                'state': state.value, 'calls': int(sum(b[1] for b in self._buckets)),
+                'failures': int(sum(b[2] for b in self._buckets)), 'opened': self.opened, 'rejected': self.rejected,
+            }
+
+
+class CircuitBreakers:
+    """A CircuitBreaker per model, created on first use with the given settings, plus fallback routes.
+
+    `fallbacks` maps a model to the one to use while its breaker is open; chains are followed
+    until a model with a usable breaker is found. Share one instance between clients so they
+    all see the same model health.
+    """
+
+    def __init__(self, fallbacks: Optional[Dict[AIModelEnum, AIModelEnum]] = None, **settings: Any):
+        self.fallbacks = dict(fallbacks or {})
+        self.settings = settings
+        self._breakers: Dict[AIModelEnum, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.fallback_calls = 0
+
+    def breaker(self, model: AIModelEnum) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(model, CircuitBreaker(**self.settings))
+        return breaker
+
+    def route(self, model: AIModelEnum) -> AIModelEnum:
+        """The model to send a request for `model` to; raises CircuitOpenError when none is available."""
+        candidate, seen = model, set()
+        while candidate not in seen:
+            if self.breaker(candidate).available():
+                if candidate is not model:
+                    with self._lock:
+                        self.fallback_calls += 1
+                return candidate
+            seen.add(candidate)
+            candidate = self.fallbacks.get(candidate, candidate)
+        raise CircuitOpenError(model, self.breaker(model).retry_after)
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Breaker stats by model name."""
+        return {model.name: breaker.stats for model, breaker in list(self._breakers.items())}
+
+
+class _UpstreamCall:
+    """Admission, feedback and retry decisions for one upstream call of YouChat or AsyncYouChat.
+
+    The clients only do the I/O: waiting for the rate limiter and a concurrency slot, opening the
+    response, sleeping between attempts. Whether an attempt may start, how its outcome is reported
+    to the concurrency slot and circuit breaker permit, which events are held back until the first
+    token, and whether a failure is retried are all decided here, once for both clients.
+    """
+
+    def __init__(self, client: 'YouChatAPI', config: YouChatConfig, metrics: StreamMetrics, deadline: StreamDeadline):
+        self.client = client
+        self.config = config
+        self.metrics = metrics
+        self.deadline = deadline
+        self.policy = config.retry
+        if self.policy is not None:
+            self.policy.record_request()
+        self.slot: Optional[ConcurrencySlot] = None
+        self.permit: Optional[CircuitPermit] = None
+        self.attempt: Optional[AttemptTiming] = None
+        self.pending: Optional[List[StreamEvent]] = None
+
+    def admit(self) -> bool:
+        """Starts the next attempt's admission: False once the call was cancelled, raises when it may not go."""
+        deadline = self.deadline
+        if deadline.cancelled:
+            return False
+        timeout = deadline.timeout_error()
+        if timeout is not None:
+            raise timeout
+        if self.client.circuit_breakers is not None:
+            breaker = self.client.circuit_breakers.breaker(self.config.model)
+            self.permit = breaker.acquire()
+            if self.permit is None:
+                raise CircuitOpenError(self.config.model, breaker.retry_after)
+        return True
+
+    def take_slot(self, slot: Optional[ConcurrencySlot], queued: float):
+        """Records a concurrency slot acquired after waiting since `queued`; None means the wait hit the deadline."""
+        self.metrics.concurrency_wait += time.perf_counter() - queued
+        if slot is None:
+            self.deadline.tripped = 'total'
+            raise self.deadline.timeout_error()
+        self.slot = slot
+
+    def start_attempt(self):
+        self.attempt = self.metrics.start_attempt()
+        # With a retry policy, events before the first token are held back so a retry never repeats them
+        self.pending = [] if self.policy is not None else None
+
+    def released(self, event: StreamEvent) -> List[StreamEvent]:
+        """The events that may be yielded now that `event` arrived."""
+        if event.type is StreamEventType.TOKEN:
+            self.deadline.token()
+        elif event.type is StreamEventType.DONE and self.deadline.tripped is not None:
+            raise self.deadline.timeout_error()
+        pending = self.pending
+        if pending is None:
+            return [event]
+        pending.append(event)
+        if event.type is not StreamEventType.TOKEN and event.type is not StreamEventType.DONE:
+            return []
+        self.pending = None
+        return pending
+
+    def failed(self, error: Exception) -> float:
+        """Reports a failed attempt and returns the delay before retrying it, or raises to give up."""
+        deadline = self.deadline
+        deadline.detach()
+        if deadline.cancelled:
+            raise error  # a lost hedge race, not a failure: the slot and permit are released without feedback
+        timeout = deadline.timeout_error(error)
+        outcome = timeout or error
+        self.metrics.end_attempt(self.attempt, outcome)
+        if self.slot is not None:
+            self.slot.release(error=outcome)
+        if self.permit is not None:
+            self.permit.release(error=outcome)
+        remaining = deadline.remaining()
+        if self.pending is None or not self.policy.should_retry(outcome, self.attempt.number, remaining):
+            if timeout is not None and timeout is not error:
+                raise timeout from error
+            raise error
+        delay = self.policy.delay(self.attempt.number, outcome)
+        return delay if remaining is None else min(delay, remaining)
+
+    def succeeded(self):
+        self.metrics.end_attempt(self.attempt)
+        latency = self.metrics.attempt_time_to_first_token(self.attempt)
+        if self.slot is not None:
+            self.slot.release(latency)
+        if self.permit is not None:
+            self.permit.release(latency)
+
+    def close(self):
+        self.deadline.close()
+        # The caller stopped reading early; give back the slot and permit without feedback
+        if self.slot is not None:
+            self.slot.release()
+        if self.permit is not None:
+            self.permit.release()
+
+
+class _HedgeCandidate:
+    """One of the racing streams of a hedged request, read by its own thread until its first token."""
+
+    def __init__(self, config: YouChatConfig, metrics: StreamMetrics, deadline: StreamDeadline,
+                 events: Iterator[StreamEvent]):
+        self.config = config
+        self.metrics = metrics
+        self.deadline = deadline
+        self.events = events
+        self.won = False
+        self.decided = threading.Event()
+
+    def start(self, results: 'queue.SimpleQueue'):
+        threading.Thread(target=self._pump, args=(results,), name='youchat-hedge', daemon=True).start()
+
+    def _pump(self, results: 'queue.SimpleQueue'):
+        # Reads up to the first token (or the end), reports it, then either hands the stream over
+        # to the reading thread or closes it
+        buffered = []
+        try:
+            for event in self.events:
+                buffered.append(event)
+                if event.type is StreamEventType.TOKEN:
+                    self.metrics.mark_token()  # the candidate's own time to first token feeds the limiter and breaker
+                    break
+                if event.type is StreamEventType.DONE:
+                    break
+        except Exception as e:
+            results.put((self, None, e))
+            return
+        results.put((self, buffered, None))
+        self.decided.wait()
+        if not self.won:
+            self.events.close()
+
+    def decide(self, won: bool):
+        self.won = won
+        if not won:
+            self.deadline.cancel()
+        self.decided.set()
+
+
+@dataclass
+class BatchResult:
+    """Outcome of one query submitted through YouChat.batch."""
+    index: int
+    query: str
+    response: Optional[Dict[str, Any]] = None
+    error: Optional[BaseException] = None
+    latency: float = 0.0
+    metrics: Optional[StreamMetrics] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class YouChatAPI(ABC):
+    """Abstract base class to define a structure for interacting with the YouChat API.
+
+    It also holds the configuration logic YouChat and AsyncYouChat share; subclasses set
+    `base_url`, `circuit_breakers` and a `_builders` dict.
+    """
+
+    def validate_configuration(self, config: YouChatConfig):
+        """Validates the configuration for model and chat mode."""
+        if not isinstance(config.model, AIModelEnum):
+            raise ModelNotAvailableError(f"Model {config.model} is not available.")
+
+        if not isinstance(config.chat_mode, ChatModeEnum):
+            raise ChatModeNotAvailableError(f"Chatmode {config.chat_mode} is not available.")
+
+    def request_builder(self, config: YouChatConfig) -> RequestBuilder:
+        """Returns the cached request template for the config's model and chat mode."""
+        key = (self.base_url, config.endpoint, config.model, config.chat_mode)
+        builder = self._builders.get(key)
+        if builder is None:
+            builder = self._builders[key] = RequestBuilder.from_config(config, self.base_url)
+        return builder
+
+    def _route(self, config: YouChatConfig, metrics: StreamMetrics) -> YouChatConfig:
+        # Switches to the fallback model while the requested model's circuit breaker is open
+        if self.circuit_breakers is None:
+            return config
+        model = self.circuit_breakers.route(config.model)
+        if model is config.model:
+            return config
+        metrics.model = model
+        return replace(config, model=model)
+
+    @abstractmethod
+    def prepare_query(self, query: str) -> str:
+        """Prepares and encodes the query string for the API."""
+        pass
+
+    @abstractmethod
+    def send_request(self, query: str, config: YouChatConfig) -> Dict[str, Any]:
+        """Sends the request to the YouChat API and returns the response."""
+        pass
+
+    @abstractmethod
+    def handle_response(self, response: requests.Response) -> Dict[str, Any]:
+        """Handles the response from the API."""
+        pass
+
+
+class YouChat(YouChatAPI):
+    """Concrete implementation of YouChatAPI to interact with YouChat's API."""
+
+    available_models: Dict[str, AIModelEnum] = {model.name: model for model in AIModelEnum}
+    available_chat_modes: List[ChatModeEnum] = list(ChatModeEnum)
+
+    base_url: str = 'https://you.com'
+    # Called with the StreamMetrics of every stream as it starts, e.g. to track active streams
+    on_stream_start: Optional[MetricsHook] = None
+
+    def __init__(self, config: YouChatConfig, session: Optional[PooledSession] = None,
+                 cache: Optional[ResponseCacheBackend] = None, single_flight: Optional[SingleFlight] = None,
+                 metrics_hook: Optional[MetricsHook] = None, rate_limiter: Optional[RateLimiter] = None,
+                 concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                 circuit_breakers: Optional[CircuitBreakers] = None):
+        self.config = config
+        self.validate_configuration(config)
+        if config.endpoint.base_url:
+            self.base_url = config.endpoint.base_url
+        self.session = session or PooledSession.from_config(config)
+        self.cache = cache
+        self.single_flight = single_flight
+        self.metrics_hook = metrics_hook
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.circuit_breakers = circuit_breakers
+        self._builders: Dict[Tuple[str, EndpointConfig, AIModelEnum, ChatModeEnum], RequestBuilder] = {}
+
+    def warm_up(self, connections: int = 1) -> int:
+        """Pre-opens pooled connections to you.com so the first queries skip the TCP/TLS handshake."""
+        return self.session.warm_up(self.base_url, connections)
+
+    @property
+    def pool_stats(self) -> Dict[str, int]:
+        """Connection pool hit/miss counters for this client's session."""
+        return self.session.stats.snapshot()
+
+    def close(self):
+        """Releases the pooled connections held by this client."""
+        self.session.close()
+
+    def __enter__(self) -> 'YouChat':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def prepare_query(self, query: str) -> str:
+        """Encodes the query to ensure it's properly formatted for the request."""
+        return percent_encode(query)
+
+    def _open_stream(self, query: str, config: YouChatConfig, chat: Optional[ChatContext] = None,
+                     metrics: Optional[StreamMetrics] = None,
+                     deadline: Optional[StreamDeadline] = None) -> requests.Response:
+        url, cookies = self.request_builder(config).build(self.prepare_query(query), chat)
+        timeout = (deadline.timeouts.connect, deadline.header_timeout()) if deadline is not None else None
+        if metrics is None:
+            return self.session.get(url, cookies=cookies, stream=True, timeout=timeout)
+        stats = self.session.stats
+        stats.take_connect_time()
+        response = self.session.get(url, cookies=cookies, stream=True, timeout=timeout)
+        metrics.mark_headers()
+        metrics.connect_time = stats.take_connect_time()
+        return response
+
+    def send_request(self, query: str, config: YouChatConfig, timeouts: Optional[Timeouts] = None) -> Dict[str, Any]:
+        """Sends the HTTP request to the YouChat API and returns the response, with its timings under 'metrics'.
+
+        When a timeout trips, the partial response is returned with the limit's name under 'timeout'.
+        """
+        metrics = StreamMetrics(config.model, config.chat_mode)
+        accumulator = ResponseAccumulator()
+        try:
+            self._collect(self.stream(query, config, metrics=metrics, timeouts=timeouts), accumulator)
+            response_dict = accumulator.to_dict()
+        except StreamTimeoutError as e:
+            response_dict = accumulator.to_dict()
+            response_dict['timeout'] = e.limit
+        response_dict['metrics'] = metrics.to_dict()
+        return response_dict
+
+    def iter_events(self, response: requests.Response, events: Optional[AbstractSet[str]] = None,
+                    metrics: Optional[StreamMetrics] = None) -> Iterator[StreamEvent]:
+        """Yields typed events from an open response as soon as each event is parsed.
+
+        Only the SSE event names in `events` (default: the config's subscription) are decoded.
+        Received bytes are counted on `metrics` when given.
+        """
+        events = self.config.events if events is None else events
+        parser = SSEParser()
+        with response:
+            if response.status_code >= 400:
+                raise HTTPStatusError(response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+            for chunk in iter_response_bytes(response):
+                if metrics is not None:
+                    metrics.bytes_received += len(chunk)
+                for message in parser.feed(chunk):
+                    yield from message_events(message, events)
+            for message in parser.close():
+                yield from message_events(message, events)
+        yield StreamEvent(StreamEventType.DONE)
+
+    def handle_response(self, response: requests.Response) -> Dict[str, Any]:
+        """Handles the API response and extracts relevant data."""
+        metrics = StreamMetrics(self.config.model, self.config.chat_mode)
+        response_dict = self._collect(self._measure(lambda: self.iter_events(response, metrics=metrics), metrics))
+        response_dict['metrics'] = metrics.to_dict()
+        return response_dict
+
+    def _collect(self, events: Iterable[StreamEvent], accumulator: Optional[ResponseAccumulator] = None) -> Dict[str, Any]:
+        accumulator = accumulator or ResponseAccumulator()
+        
+        for event in events:
+            accumulator.add(event)
+            if event.type is StreamEventType.TOKEN and self.config.prints:
+                print(event.data, end='', flush=True)
+        return accumulator.to_dict()
+
+    def stream(self, query: str, config: Optional[YouChatConfig] = None,
+               accumulator: Optional[ResponseAccumulator] = None,
+               events: Optional[AbstractSet[str]] = None, chat: Optional[ChatContext] = None,
+               metrics: Optional[StreamMetrics] = None, timeouts: Optional[Timeouts] = None) -> Iterator[StreamEvent]:
+        """Sends the request and yields typed events (token, query, related searches, done) as they arrive.
+
+        Pass a ResponseAccumulator to also collect the response; otherwise no answer text is built.
+        `events` overrides which SSE event names are decoded for this call, and `chat` continues a
+        conversation (such requests bypass the cache and single-flight). Timings are recorded on
+        `metrics` (a new StreamMetrics by default) and passed to the client's metrics hook.
+        `timeouts` overrides config.timeouts; when one trips the stream is cut and StreamTimeoutError
+        is raised after the events received so far.
+        """
+        config = config or self.config
+        events = config.events if events is None else events
+        metrics = metrics or StreamMetrics(config.model, config.chat_mode)
+        timeouts = timeouts or config.timeouts
+        if chat is not None:
+            def source() -> Iterator[StreamEvent]:
+                return self._live_events(query, self._route(config, metrics), events, metrics, chat, timeouts)
+        else:
+            def source() -> Iterator[StreamEvent]:
+                return self._events_for(query, config, events, metrics, timeouts)
+        for event in self._measure(source, metrics):
+            if accumulator is not None:
+                accumulator.add(event)
+            yield event
+
+    def _measure(self, open_source: Callable[[], Iterable[StreamEvent]], metrics: StreamMetrics) -> Iterator[StreamEvent]:
+        # Opens the source, records token timings as events pass through and reports the finished metrics to the hook
+        if self.on_stream_start is not None:
+            self.on_stream_start(metrics)
+        try:
+            for event in open_source():
+                if event.type is StreamEventType.TOKEN:
+                    metrics.mark_token()
+                yield event
+        except Exception as e:
+            metrics.error = type(e).__name__
+            if isinstance(e, StreamTimeoutError):
+                metrics.timeout = e.limit
+            raise
+        finally:
+            metrics.finish()
+            if self.metrics_hook is not None:
+                self.metrics_hook(metrics)
+
+    def _events_for(self, query: str, config: YouChatConfig, events: AbstractSet[str],
+                    metrics: StreamMetrics, timeouts: Optional[Timeouts] = None) -> Iterator[StreamEvent]:
+        # Serves the query from the response cache when possible, otherwise streams it live,
+        # sharing one upstream stream between identical concurrent calls when single-flight is on.
+        # The cache is checked under the requested model, so an open circuit breaker only affects misses.
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(config.model, config.chat_mode, query, events)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                metrics.cached = True
+                return replay_events(cached)
+        routed = self._route(config, metrics)
+        if routed is not config:
+            config = routed
+            if cache_key is not None:
+                cache_key = self.cache.key(config.model, config.chat_mode, query, events)
+
+        def upstream() -> Iterator[StreamEvent]:
+            if config.hedge is not None:
+                return self._hedged_events(query, config, events, metrics, timeouts, cache_key)
+            live = self._live_events(query, config, events, metrics, timeouts=timeouts)
+            return live if cache_key is None else record_stream(live, self.cache, cache_key)
+
+        if self.single_flight is None:
+            return upstream()
+        return self.single_flight.stream((config.model, config.chat_mode, query, frozenset(events)), upstream)
+
+    def _hedge_config(self, config: YouChatConfig) -> Optional[YouChatConfig]:
+        # The config for the duplicate request, or None when the hedge model's circuit breaker is open
+        # or the concurrency limiter has no spare slot: hedges only use capacity nobody is waiting for
+        model = config.hedge.model or config.model
+        if self.circuit_breakers is not None and not self.circuit_breakers.breaker(model).available():
+            return None
+        if self.concurrency_limiter is not None:
+            stats = self.concurrency_limiter.stats
+            if stats['waiting'] or stats['in_flight'] >= stats['limit']:
+                return None
+        return config if model is config.model else replace(config, model=model)
+
+    def _hedged_events(self, query: str, config: YouChatConfig, events: AbstractSet[str], metrics: StreamMetrics,
+                       timeouts: Optional[Timeouts], cache_key: Optional[CacheKey]) -> Iterator[StreamEvent]:
+        # Races the request against a duplicate sent once the hedge delay passes without a first token.
+        # Each candidate is read by its own thread only until its first token; the winner's stream is
+        # then read directly from here and the loser is cancelled.
+        policy = config.hedge
+        timeouts = timeouts or config.timeouts
+        results: 'queue.SimpleQueue' = queue.SimpleQueue()
+        candidates: List[_HedgeCandidate] = []
+
+        def launch(candidate_config: YouChatConfig):
+            deadline = StreamDeadline(timeouts)
+            if candidates:
+                deadline.started = candidates[0].deadline.started  # limits still count from the original call
+            candidate_metrics = StreamMetrics(candidate_config.model, candidate_config.chat_mode, started=metrics.started)
+            candidate = _HedgeCandidate(candidate_config, candidate_metrics, deadline, self._live_events(
+                query, candidate_config, events, candidate_metrics, timeouts=timeouts, deadline=deadline))
+            candidates.append(candidate)
+            candidate.start(results)
+
+        launch(config)
+        delay: Optional[float] = policy.delay(config.model)
+        winner: Optional[_HedgeCandidate] = None
+        errors: List[BaseException] = []
+        try:
+            while winner is None:
+                try:
+                    candidate, buffered, error = results.get(timeout=delay)
+                except queue.Empty:
+                    delay = None
+                    hedge_config = self._hedge_config(config)
+                    if hedge_config is not None:
+                        launch(hedge_config)
+                        metrics.hedged = True
+                        policy.count(fired=1)
+                    continue
+                if error is None:
+                    winner = candidate
+                    continue
+                errors.append(error)
+                if len(errors) == len(candidates):
+                    raise errors[0]
+            for candidate in candidates:
+                candidate.decide(candidate is winner)
+            metrics.model = winner.config.model
+            if winner is not candidates[0]:
+                metrics.hedge_won = True
+                policy.count(won=1)
+            stream: Iterator[StreamEvent] = itertools.chain(buffered, winner.events)
+            if cache_key is not None and winner.config.model is config.model:
+                stream = record_stream(stream, self.cache, cache_key)
+            yield from stream
+            policy.record(metrics)
+        finally:
+            for candidate in candidates:
+                if not candidate.decided.is_set():
+                    candidate.decide(False)
+            if winner is not None:
+                winner.events.close()
+                for name in ('connect_time', 'time_to_headers', 'bytes_received', 'rate_limit_wait',
+                             'concurrency_wait', 'attempts'):
+                    setattr(metrics, name, getattr(winner.metrics, name))
+
+    def _live_events(self, query: str, config: YouChatConfig, events: AbstractSet[str], metrics: StreamMetrics,
+                     chat: Optional[ChatContext] = None, timeouts: Optional[Timeouts] = None,
+                     deadline: Optional[StreamDeadline] = None) -> Iterator[StreamEvent]:
+        # Streams the response from the API, retrying per config.retry until the first token arrives.
+        # With a retry policy, events before the first token are held back so a retry never repeats them.
+        # The shared watchdog aborts the response once a timeout passes; the error is raised from here.
+        call = _UpstreamCall(self, config, metrics, deadline or StreamDeadline(timeouts or config.timeouts))
+        deadline = call.deadline
+        deadline.watch()
+        try:
+            while call.admit():
+                if self.rate_limiter is not None:
+                    metrics.rate_limit_wait += self.rate_limiter.acquire(config.model, deadline.remaining())
+                if self.concurrency_limiter is not None:
+                    queued = time.perf_counter()
+                    call.take_slot(self.concurrency_limiter.acquire(deadline.remaining()), queued)
+                call.start_attempt()
+                try:
+                    response = self._open_stream(query, config, chat, metrics, deadline)
+                    sock = _response_socket(response)
+                    if sock is not None:
+                        # The short read timeout only guarded the headers; from here on the watchdog enforces the limits
+                        sock.settimeout(deadline.timeouts.read_backstop)
+                    deadline.attach(lambda: _abort_response(response))
+                    for event in self.iter_events(response, events, metrics):
+                        yield from call.released(event)
+                except Exception as e:
+                    time.sleep(call.failed(e))
+                    continue
+                call.succeeded()
+                return
+        finally:
+            call.close()
+
+    def tokens(self, query: str, config: Optional[YouChatConfig] = None) -> Iterator[str]:
+        """Yields only the youChatToken text of a streamed response."""
+        for event in self.stream(query, config, events=TOKEN_EVENTS):
+            if event.type is StreamEventType.TOKEN:
+                yield event.data
+
+    def _run_batch_item(self, index: int, query: str, config: YouChatConfig) -> BatchResult:
+        result = BatchResult(index, query, metrics=StreamMetrics(config.model, config.chat_mode))
+        start = time.perf_counter()
+        accumulator = ResponseAccumulator()
+        try:
+            for _ in self.stream(query, config, accumulator, metrics=result.metrics):
+                pass
+            result.response = accumulator.to_dict()
+        except StreamTimeoutError as e:
+            result.error = e
+            result.response = accumulator.to_dict()  # the partial answer received before the timeout
+        except Exception as e:
+            result.error = e
+        result.latency = time.perf_counter() - start
+        return result
+
+    def batch(self, queries: Iterable[str], max_workers: Optional[int] = None,
+              config: Optional[YouChatConfig] = None, ordered: bool = True) -> Iterator[BatchResult]:
+        """Runs many queries concurrently over this client's pooled session.
+
+        At most `max_workers` requests are in flight at once; the default is the pool size (capped
+        further by the concurrency limiter's max_limit, when one is set, so that connections beyond
+        the pool are never opened and thrown away). Results are yielded in submission
+        order, or as they complete when `ordered` is False. A failing query is reported through its
+        BatchResult instead of aborting the batch (a timed-out one keeps its partial response), and
+        responses are never printed. Closing the generator early cancels the queries not yet started.
+        """
+        config = config or self.config
+        if max_workers is None:
+            max_workers = config.pool_maxsize
+            if self.concurrency_limiter is not None:
+                max_workers = min(max_workers, self.concurrency_limiter.max_limit)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = [executor.submit(self._run_batch_item, index, query, config) for index, query in enumerate(queries)]
+            for future in (futures if ordered else as_completed(futures)):
+                yield future.result()
+        finally:
+            # A caller that stops iterating early drops the queries that have not started yet;
+            # the ones already running finish in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _connect_trace_config() -> 'aiohttp.TraceConfig':
+    # Times new connections for requests that pass their StreamMetrics as trace_request_ctx
+    async def on_start(session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def on_end(session, context, params):
+        if isinstance(context.trace_request_ctx, StreamMetrics):
+            context.trace_request_ctx.connect_time = time.perf_counter() - context.connect_started
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_start)
+    trace_config.on_connection_create_end.append(on_end)
+    return trace_config
+
+
+class AsyncYouChat(YouChatAPI):
+    """asyncio implementation of YouChatAPI built on aiohttp, for driving many streams from one event loop."""
+
+    base_url: str = 'https://you.com'
+    on_stream_start: Optional[MetricsHook] = None
+
+    def __init__(self, config: YouChatConfig, session: Optional['aiohttp.ClientSession'] = None,
+                 cache: Optional[ResponseCacheBackend] = None, single_flight: Optional[AsyncSingleFlight] = None,
+                 metrics_hook: Optional[MetricsHook] = None, rate_limiter: Optional[RateLimiter] = None,
+                 concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                 circuit_breakers: Optional[CircuitBreakers] = None):
+        if aiohttp is None:
+            raise ImportError("AsyncYouChat requires aiohttp. Install it with 'pip install aiohttp'.")
+        self.config = config
+        self.validate_configuration(config)
+        if config.endpoint.base_url:
+            self.base_url = config.endpoint.base_url
+        self.session = session
+        self.cache = cache
+        self.single_flight = single_flight
+        self.metrics_hook = metrics_hook
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.circuit_breakers = circuit_breakers
+        self._owns_session = session is None
+        self._builders: Dict[Tuple[str, EndpointConfig, AIModelEnum, ChatModeEnum], RequestBuilder] = {}
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        # aiohttp sessions must be created inside the running loop, so build it on first use.
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.config.pool_maxsize, force_close=not self.config.keep_alive)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[_connect_trace_config()])
+            self._owns_session = True
+        return self.session
+
+    async def close(self):
+        """Closes the underlying aiohttp session if this client created it."""
+        if self._owns_session and self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def __aenter__(self) -> 'AsyncYouChat':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def prepare_query(self, query: str) -> str:
+        """Encodes the query to ensure it's properly formatted for the request."""
+        return percent_encode(query)
+
+    def _open_stream(self, query: str, config: YouChatConfig, chat: Optional[ChatContext] = None,
+                     metrics: Optional[StreamMetrics] = None,
+                     timeouts: Optional[Timeouts] = None) -> 'aiohttp.client._RequestContextManager':
+        url, cookies = self.request_builder(config).build(self.prepare_query(query), chat)
+        timeouts = timeouts or config.timeouts
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeouts.connect, sock_read=timeouts.read_backstop)
+        return self._get_session().get(url, cookies=cookies, trace_request_ctx=metrics, timeout=timeout)
+
+    async def send_request(self, query: str, config: YouChatConfig, timeouts: Optional[Timeouts] = None) -> Dict[str, Any]:
+        """Sends the HTTP request to the YouChat API and returns the response, with its timings under 'metrics'.
+
+        When a timeout trips, the partial response is returned with the limit's name under 'timeout'.
+        """
+        metrics = StreamMetrics(config.model, config.chat_mode)
+        accumulator = ResponseAccumulator()
+        try:
+            await self._collect(self.stream(query, config, metrics=metrics, timeouts=timeouts), accumulator)
+            response_dict = accumulator.to_dict()
+        except StreamTimeoutError as e:
+            response_dict = accumulator.to_dict()
+            response_dict['timeout'] = e.limit
+        response_dict['metrics'] = metrics.to_dict()
+        return response_dict
+
+    async def iter_events(self, response: 'aiohttp.ClientResponse', events: Optional[AbstractSet[str]] = None,
+                          metrics: Optional[StreamMetrics] = None) -> AsyncIterator[StreamEvent]:
+        """Yields typed events from an open response as soon as each event is parsed.
+
+        Only the SSE event names in `events` (default: the config's subscription) are decoded.
+        Received bytes are counted on `metrics` when given.
+        """
+        events = self.config.events if events is None else events
+        if response.status >= 400:
+            raise HTTPStatusError(response.status, parse_retry_after(response.headers.get('Retry-After')))
+        parser = SSEParser()
+        async for chunk in response.content.iter_any():
+            if metrics is not None:
+                metrics.bytes_received += len(chunk)
+            for message in parser.feed(chunk):
+                for event in message_events(message, events):
+                    yield event
+        for message in parser.close():
+            for event in message_events(message, events):
+                yield event
+        yield StreamEvent(StreamEventType.DONE)
+
+    async def handle_response(self, response: 'aiohttp.ClientResponse') -> Dict[str, Any]:
+        """Handles the API response and extracts relevant data."""
+        metrics = StreamMetrics(self.config.model, self.config.chat_mode)
+
+        async def open_source() -> AsyncIterator[StreamEvent]:
+            return self.iter_events(response, metrics=metrics)
+
+        response_dict = await self._collect(self._measure(open_source, metrics))
+        response_dict['metrics'] = metrics.to_dict()
+        return response_dict
+
+    async def _collect(self, events: AsyncIterator[StreamEvent],
+                       accumulator: Optional[ResponseAccumulator] = None) -> Dict[str, Any]:
+        accumulator = accumulator or ResponseAccumulator()
+        async for event in events:
+            accumulator.add(event)
+            if event.type is StreamEventType.TOKEN and self.config.prints:
+                print(event.data, end='', flush=True)
+        return accumulator.to_dict()
+
+    async def stream(self, query: str, config: Optional[YouChatConfig] = None,
+                     accumulator: Optional[ResponseAccumulator] = None,
+                     events: Optional[AbstractSet[str]] = None,
+                     chat: Optional[ChatContext] = None,
+                     metrics: Optional[StreamMetrics] = None,
+                     timeouts: Optional[Timeouts] = None) -> AsyncIterator[StreamEvent]:
+        """Yields typed events (token, query, related searches, done) as soon as they arrive.
+
+        Pass a ResponseAccumulator to also collect the response; otherwise no answer text is built.
+        `events` overrides which SSE event names are decoded for this call, and `chat` continues a
+        conversation (such requests bypass the cache and single-flight). Timings are recorded on
+        `metrics` (a new StreamMetrics by default) and passed to the client's metrics hook.
+        `timeouts` overrides config.timeouts; when one trips the stream is cut and StreamTimeoutError
+        is raised after the events received so far.
+        """
+        config = config or self.config
+        events = config.events if events is None else events
+        metrics = metrics or StreamMetrics(config.model, config.chat_mode)
+        timeouts = timeouts or config.timeouts
+
+        async def open_source() -> AsyncIterator[StreamEvent]:
+            # The cache is checked under the requested model, so an open circuit breaker only affects misses
+            use_cache = self.cache is not None and chat is None
+            cache_key = self.cache.key(config.model, config.chat_mode, query, events) if use_cache else None
+            cached = await self.cache.get_async(cache_key) if cache_key is not None else None
+            if cached is not None:
+                metrics.cached = True
+                return self._replay(cached)
+            routed = self._route(config, metrics)
+            if routed is not config and cache_key is not None:
+                cache_key = self.cache.key(routed.model, routed.chat_mode, query, events)
+            if self.single_flight is None or chat is not None:
+                return self._live_events(query, routed, events, cache_key, chat, metrics, timeouts)
+            return self.single_flight.stream((routed.model, routed.chat_mode, query, frozenset(events)),
+                                             lambda: self._live_events(query, routed, events, cache_key,
+                                                                       metrics=metrics, timeouts=timeouts))
+
+        measured = self._measure(open_source, metrics)
+        try:
+            async for event in measured:
+                if accumulator is not None:
+                    accumulator.add(event)
+                yield event
+        finally:
+            # Close the source right away so the connection or shared flight is released without waiting for GC
+            await measured.aclose()
+
+    async def _measure(self, open_source: Callable[[], Awaitable[AsyncIterator[StreamEvent]]],
+                       metrics: StreamMetrics) -> AsyncIterator[StreamEvent]:
+        # Opens the source, records token timings as events pass through and reports the finished metrics to the hook
+        if self.on_stream_start is not None:
+            self.on_stream_start(metrics)
+        source = None
+        try:
+            source = await open_source()
+            async for event in source:
+                if event.type is StreamEventType.TOKEN:
+                    metrics.mark_token()
+                yield event
+        except Exception as e:
+            metrics.error = type(e).__name__
+            if isinstance(e, StreamTimeoutError):
+                metrics.timeout = e.limit
+            raise
+        finally:
+            if source is not None:
+                await source.aclose()
+            metrics.finish()
+            if self.metrics_hook is not None:
+                self.metrics_hook(metrics)
+
+    @staticmethod
+    async def _replay(events: Iterable[StreamEvent]) -> AsyncIterator[StreamEvent]:
+        for event in replay_events(events):
+            yield event
+
+    async def _live_events(self, query: str, config: YouChatConfig, events: AbstractSet[str],
+                           cache_key: Optional[CacheKey], chat: Optional[ChatContext] = None,
+                           metrics: Optional[StreamMetrics] = None,
+                           timeouts: Optional[Timeouts] = None) -> AsyncIterator[StreamEvent]:
+        # Streams the response from the API, retrying per config.retry until the first token arrives.
+        # With a retry policy, events before the first token are held back so a retry never repeats them.
+        # A loop timer closes the response once a timeout passes; the error is raised from here.
+        metrics = metrics or StreamMetrics(config.model, config.chat_mode)
+        call = _UpstreamCall(self, config, metrics, StreamDeadline(timeouts or config.timeouts))
+        deadline = call.deadline
+        deadline.watch_async()
+        try:
+            while call.admit():
+                if self.rate_limiter is not None:
+                    metrics.rate_limit_wait += await self.rate_limiter.acquire_async(config.model, deadline.remaining())
+                if self.concurrency_limiter is not None:
+                    queued = time.perf_counter()
+                    call.take_slot(await self.concurrency_limiter.acquire_async(deadline.remaining()), queued)
+                call.start_attempt()
+                recorded = []
+                try:
+                    response = await asyncio.wait_for(self._open_stream(query, config, chat, metrics, deadline.timeouts),
+                                                      deadline.header_timeout())
+                    async with response:
+                        metrics.mark_headers()
+                        deadline.attach(response.close)
+                        async for event in self.iter_events(response, events, metrics):
+                            released = call.released(event)  # raises before a timed-out stream is cached
+                            if cache_key is not None:
+                                if event.type is StreamEventType.DONE:
+                                    await self.cache.set_async(cache_key, recorded)
+                                else:
+                                    recorded.append(event)
+                            for released_event in released:
+                                yield released_event
+                except Exception as e:
+                    await asyncio.sleep(call.failed(e))
+                    continue
+                call.succeeded()
+                return
+        finally:
+            call.close()
+
+    async def tokens(self, query: str, config: Optional[YouChatConfig] = None) -> AsyncIterator[str]:
+        """Yields each youChatToken as soon as it arrives: `async for token in client.tokens(query)`."""
+        async for event in self.stream(query, config, events=TOKEN_EVENTS):
+            if event.type is StreamEventType.TOKEN:
+                yield event.data
+
+
+def _encode_turn(question: str, answer: str) -> str:
+    return percent_encode(json.dumps({'question': question, 'answer': answer}, separators=(',', ':')))
+
+
+def _fit_turn(question: str, answer: str, limit: int) -> Tuple[str, str, str]:
+    # Encoded size grows with the prefix length but not linearly (escapes, multi-byte characters),
+    # so the longest answer prefix that fits is found by bisection; the question is only cut when
+    # even an empty answer does not fit
+    def longest(fits: Callable[[int], bool], length: int) -> int:
+        low, high = 0, length
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    if len(_encode_turn(question, '')) <= limit:
+        answer = answer[:longest(lambda n: len(_encode_turn(question, answer[:n])) <= limit, len(answer))]
+    else:
+        answer = ''
+        question = question[:longest(lambda n: len(_encode_turn(question[:n], '')) <= limit, len(question))]
+    return question, answer, _encode_turn(question, answer)
+
+
+class Conversation:
+    """Multi-turn chat on top of YouChat or AsyncYouChat that keeps history and reuses one chatId.
+
+    Each finished turn is JSON- and percent-encoded exactly once, so building the `chat` parameter
+    for the next request only joins already encoded turns. The oldest turns are dropped once the
+    encoded history exceeds `max_history_bytes` or `max_turns`, which keeps the URL and request
+    cost bounded on long sessions.
+    """
+
+    def __init__(self, client: Union[YouChat, AsyncYouChat], config: Optional[YouChatConfig] = None,
+                 max_history_bytes: int = 8192, max_turns: Optional[int] = None, chat_id: Optional[str] = None):
+        self.client = client
+        self.config = config or client.config
+        self.chat_id = chat_id or uuid4_strings(1)[0]
+        self.max_history_bytes = max_history_bytes
+        self.max_turns = max_turns
+        self.turns: Deque[Tuple[str, str]] = deque()
+        self._encoded: Deque[str] = deque()
+        self._encoded_bytes = 0
+        self._chat_param: Optional[str] = '%5B%5D'
+
+    def add_turn(self, question: str, answer: str):
+        """Appends a finished turn to the history, trimming the oldest turns to stay within the caps.
+
+        The newest turn is always kept; if it alone exceeds `max_history_bytes`, the end of its answer
+        (and, if that is not enough, of its question) is cut off until it fits.
+        """
+        encoded = _encode_turn(question, answer)
+        if len(encoded) + 6 > self.max_history_bytes:
+            question, answer, encoded = _fit_turn(question, answer, self.max_history_bytes - 6)
+        self.turns.append((question, answer))
+        self._encoded.append(encoded)
+        self._encoded_bytes += len(encoded)
+        while self._encoded and ((len(self._encoded) > 1 and self.history_bytes > self.max_history_bytes)
+                                 or (self.max_turns is not None and len(self._encoded) > self.max_turns)):
+            self.turns.popleft()
+            self._encoded_bytes -= len(self._encoded.popleft())
+        self._chat_param = None
+
+    @property
+    def history_bytes(self) -> int:
+        """Size of the encoded `chat` URL parameter for the current history."""
+        # '%5B' + turns joined by '%2C' + '%5D'
+        return self._encoded_bytes + 3 * max(len(self._encoded) - 1, 0) + 6
+
+    def context(self) -> ChatContext:
+        """Returns the chat ID and encoded history to send with the next request."""
+        if self._chat_param is None:
+            self._chat_param = '%5B' + '%2C'.join(self._encoded) + '%5D'
+        return ChatContext(self.chat_id, len(self._encoded), self._chat_param)
+
+    def clear(self):
+        """Forgets the history but keeps the chat ID."""
+        self.turns.clear()
+        self._encoded.clear()
+        self._encoded_bytes = 0
+        self._chat_param = '%5B%5D'
+
+    def stream(self, query: str, events: Optional[AbstractSet[str]] = None) -> Iterator[StreamEvent]:
+        """Streams the next turn from a YouChat client and records it once the answer is complete."""
+        accumulator = ResponseAccumulator()
+        for event in self.client.stream(query, self.config, accumulator, events, chat=self.context()):
+            yield event
+        self.add_turn(query, accumulator.text)
+
+    def ask(self, query: str) -> Dict[str, Any]:
+        """Sends the next turn from a YouChat client and returns the response."""
+        return self.client._collect(self.stream(query))
+
+    async def stream_async(self, query: str, events: Optional[AbstractSet[str]] = None) -> AsyncIterator[StreamEvent]:
+        """Streams the next turn from an AsyncYouChat client and records it once the answer is complete."""
+        accumulator = ResponseAccumulator()
+        async for event in self.client.stream(query, self.config, accumulator, events, chat=self.context()):
+            yield event
+        self.add_turn(query, accumulator.text)
+
+    async def ask_async(self, query: str) -> Dict[str, Any]:
+        """Sends the next turn from an AsyncYouChat client and returns the response."""
+        return await self.client._collect(self.stream_async(query))
+
+
 def main():
     """Main function to demonstrate YouChat interaction."""
     config = YouChatConfig(
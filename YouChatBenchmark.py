@@ -0,0 +1,289 @@
+import io
+import json
+import random
+import sys
+import time
+import tracemalloc
+import urllib.parse
+import uuid
+from datetime import datetime
+from typing import AbstractSet, Any, Callable, Dict, List, Optional
+
+import requests
+
+from YouChat import (DEFAULT_STREAM_EVENTS, JSON_BACKENDS, TOKEN_EVENTS, AIModelEnum, ChatModeEnum, RequestBuilder,
+                     SSEParser, YouChat, YouChatConfig, get_json_backend, message_events, percent_encode,
+                     set_json_backend)
+from YouChatReplay import SSEFixture, replay
+
+
+def make_stream(tokens: int = 20000) -> bytes:
+    """Builds a synthetic streamingSearch body shaped like the real event stream."""
+    results = json.dumps({'search': {'third_party_search_results': [
+        {'url': f'https://example.com/{i}', 'name': f'Result {i}', 'snippet': 'lorem ipsum ' * 20} for i in range(50)
+    ]}}).encode()
+    frames = [b'event: youChatIntent\ndata: {"intent": "chat"}\n\n',
+              b'event: query\ndata: {"query": "benchmark", "queryTraceId": "0"}\n\n',
+              b'event: thirdPartySearchResults\ndata: ' + results + b'\n\n']
+    for i in range(tokens):
+        frames.append(b'event: youChatToken\ndata: {"youChatToken": "token %d "}\n\n' % i)
+        if i % 10 == 0:
+            frames.append(b'event: youChatUpdate\ndata: {"t": "Searching", "nested": {"step": %d, "done": false}}\n\n' % i)
+    frames.append(b'event: relatedSearches\ndata: {"relatedSearches": ["a", "b", "c"]}\n\n')
+    frames.append(b"event: done\ndata: I'm done\n\n")
+    return b''.join(frames)
+
+
+def chunked(body: bytes, chunk_size: int) -> List[bytes]:
+    return [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+
+def replayed_response(body: bytes) -> requests.Response:
+    """A requests.Response whose body is read from memory, for exercising iter_lines offline."""
+    response = requests.Response()
+    response.raw = io.BytesIO(body)
+    response.encoding = 'utf-8'
+    response.status_code = 200
+    return response
+
+
+def legacy_loop(body: bytes) -> int:
+    """The original handle_response loop: iter_lines(decode_unicode=True) and json.loads on every data line."""
+    tokens = 0
+    for value in replayed_response(body).iter_lines(decode_unicode=True, chunk_size=1000):
+        if value and 'event:' not in value:
+            value = value.replace('data: ', '')
+            try:
+                json_value = json.loads(value)
+                if isinstance(json_value, dict) and json_value.get('youChatToken'):
+                    tokens += 1
+            except:continue
+    return tokens
+
+
+def legacy_framing(body: bytes) -> int:
+    """Only the line handling of the original loop, without JSON decoding."""
+    payloads = 0
+    for value in replayed_response(body).iter_lines(decode_unicode=True, chunk_size=1000):
+        if value and 'event:' not in value:
+            value = value.replace('data: ', '')
+            payloads += 1
+    return payloads
+
+
+def sse_framing(body: bytes) -> int:
+    """Only SSEParser framing, without JSON decoding."""
+    parser = SSEParser()
+    payloads = 0
+    for chunk in chunked(body, 1000):
+        payloads += len(parser.feed(chunk))
+    return payloads + len(parser.close())
+
+
+def sse_parser(body: bytes, events: AbstractSet[str] = DEFAULT_STREAM_EVENTS) -> int:
+    """The incremental byte-level SSEParser path used by YouChat.iter_events."""
+    tokens = 0
+    parser = SSEParser()
+    for chunk in chunked(body, 1000):
+        for message in parser.feed(chunk):
+            tokens += len(message_events(message, events))
+    for message in parser.close():
+        tokens += len(message_events(message, events))
+    return tokens
+
+
+def bench(name: str, func: Callable, *args, repeat: int = 5) -> float:
+    """Runs func `repeat` times and prints the best wall time."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<40} {best * 1000:9.2f} ms")
+    return best
+
+
+def bench_parsers() -> Dict[str, float]:
+    body = make_stream()
+    print(f"SSE parsing: {len(body) / 1e6:.2f} MB in 1000 byte chunks")
+    return {
+        'legacy_framing': bench('legacy iter_lines framing only', legacy_framing, body),
+        'sse_framing': bench('SSEParser framing only', sse_framing, body),
+        'legacy_loop': bench('legacy iter_lines + json.loads loop', legacy_loop, body),
+        'sse_parser': bench('SSEParser + message_events', sse_parser, body),
+    }
+
+
+def decode_payloads(loads: Callable[[bytes], Any], payloads: List[bytes]) -> int:
+    """Decodes every payload with one JSON backend and returns how many were valid JSON."""
+    decoded = 0
+    for payload in payloads:
+        try:
+            loads(payload)
+            decoded += 1
+        except ValueError:
+            pass
+    return decoded
+
+
+def bench_json_backends() -> Dict[str, float]:
+    """Per-event decode cost of each JSON backend, in seconds, on the payloads of a synthetic stream."""
+    body = make_stream()
+    parser = SSEParser()
+    payloads = [message.data for chunk in chunked(body, 1000) for message in parser.feed(chunk)]
+    payloads += [message.data for message in parser.close()]
+    print(f"Payload decoding with each JSON backend: {len(payloads)} events")
+    results = {}
+    previous = get_json_backend()
+    try:
+        for name, loads in JSON_BACKENDS.items():
+            results[name] = bench(f'decode payloads [{name}]', decode_payloads, loads, payloads) / len(payloads)
+            print(f"{'':<40} {results[name] * 1e6:9.3f} us per event")
+            set_json_backend(name)
+            bench(f'SSEParser + message_events [{name}]', sse_parser, body)
+    finally:
+        set_json_backend(previous)
+    return results
+
+
+def bench_subscriptions() -> Dict[str, float]:
+    body = make_stream()
+    every_event = DEFAULT_STREAM_EVENTS | {'youChatIntent', 'youChatUpdate', 'thirdPartySearchResults'}
+    print("Event subscriptions")
+    return {
+        'all_events': bench('decode every event', sse_parser, body, every_event),
+        'default_events': bench('decode default subscription', sse_parser, body),
+        'token_events': bench('decode youChatToken only', sse_parser, body, TOKEN_EVENTS),
+    }
+
+
+def legacy_prepare_query(query: str) -> str:
+    """The original prepare_query: one str.replace pass per reserved character."""
+    replacements = {
+        ' ': '%20', '?': '%3F', '&': '%26', '"': '%22', "'": '%27', ',': '%2C',
+        ';': '%3B', ':': '%3A', '/': '%2F', '\\': '%5C', '|': '%7C', '=': '%3D', '+': '%2B'
+    }
+    for char, replacement in replacements.items():
+        query = query.replace(char, replacement)
+    return query
+
+
+def repeat_calls(func: Callable, text: str, calls: int) -> None:
+    for _ in range(calls):
+        func(text)
+
+
+def bench_query_encoding() -> Dict[str, float]:
+    short = "What is current AQI in New Delhi?"
+    pasted = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit; naïve café #1 at 50% off: "
+              "'quoted' & \"double\" / path?x=1\n") * 64
+    # Non-Latin prompts: every character needs a multi-byte escape and there are many distinct ones
+    rng = random.Random(0)
+    cjk = ''.join(chr(rng.randrange(0x4E00, 0xA000)) for _ in range(4000))
+    hindi = ("दिल्ली में वायु गुणवत्ता सूचकांक क्या है? कृपया विस्तार से बताएं, और स्वास्थ्य पर प्रभाव भी। ") * 32
+    print(f"Query encoding: 10000 x {len(short)} chars, 100 x {len(pasted)} chars, "
+          f"100 x {len(cjk)} CJK chars, 100 x {len(hindi.encode('utf-8'))} byte Hindi")
+    results = {}
+    for name, func in (('legacy', legacy_prepare_query), ('percent_encode', percent_encode),
+                       ('urllib.parse.quote', lambda text: urllib.parse.quote(text, safe='~'))):
+        results[f'{name}_short'] = bench(f'{name} [short]', repeat_calls, func, short, 10000)
+        results[f'{name}_pasted'] = bench(f'{name} [pasted]', repeat_calls, func, pasted, 100)
+        results[f'{name}_cjk'] = bench(f'{name} [cjk]', repeat_calls, func, cjk, 100)
+        results[f'{name}_hindi'] = bench(f'{name} [hindi]', repeat_calls, func, hindi, 100)
+    return results
+
+
+def legacy_build_request(query: str, model: AIModelEnum, chat_mode: ChatModeEnum) -> tuple:
+    """The original send_request URL f-string and cookies dict."""
+    cookies = {
+        'safesearch_guest': 'Moderate',
+        'youchat_personalization': 'true',
+        'youchat_smart_learn': 'true',
+        'youpro_subscription': 'true',
+        'guest_has_seen_legal_disclaimer': 'true',
+        'ai_model': str(model.value),
+        'you_subscription': 'premium',
+        'DS': str(uuid.uuid4())
+    }
+    url = f'https://you.com/api/streamingSearch?page=1&count=10&safeSearch=Moderate&utm=brave&mkt=en-IN&enable_worklow_generation_ux=true&domain=youchat&use_personalization_extraction=true&queryTraceId={uuid.uuid4()}&chatId={uuid.uuid4()}&conversationTurnId={uuid.uuid4()}&pastChatLength=0&selectedChatMode={chat_mode.value}&selectedAiModel={model.value}&enable_agent_clarification_questions=true&traceId={uuid.uuid4()}|{uuid.uuid4()}|{datetime.now().isoformat()}&use_nested_youchat_updates=true&q={query}&chat=%5B%5D'
+    return url, cookies
+
+
+def bench_request_building() -> Dict[str, float]:
+    query = percent_encode("What is current AQI in New Delhi?")
+    model, chat_mode = AIModelEnum.GPT_4O, ChatModeEnum.DEFAULT
+    builder = RequestBuilder(model, chat_mode)
+    print("Request building: 10000 requests")
+    return {
+        'legacy': bench('legacy f-string + uuid4 x6', repeat_calls, lambda q: legacy_build_request(q, model, chat_mode), query, 10000),
+        'request_builder': bench('RequestBuilder.build', repeat_calls, builder.build, query, 10000),
+    }
+
+
+def parse_fixture(fixture: SSEFixture, events: AbstractSet[str] = DEFAULT_STREAM_EVENTS) -> int:
+    """Runs a fixture's recorded chunks through SSEParser and message_events and returns the event count."""
+    count = 0
+    parser = SSEParser()
+    for chunk in fixture.chunks:
+        for message in parser.feed(chunk):
+            count += len(message_events(message, events))
+    for message in parser.close():
+        count += len(message_events(message, events))
+    return count
+
+
+def peak_allocated(func: Callable, *args) -> int:
+    """Peak bytes allocated by Python while running func once."""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def replay_requests(client: YouChat, config: YouChatConfig, calls: int) -> None:
+    for _ in range(calls):
+        client.send_request('benchmark', config)
+
+
+def bench_fixtures(fixtures: Optional[List[SSEFixture]] = None) -> Dict[str, Dict[str, float]]:
+    """Parse throughput and peak allocations for recorded fixtures, plus full send_request replays."""
+    fixtures = fixtures or [SSEFixture.from_body(make_stream(), query='synthetic')]
+    config = YouChatConfig(AIModelEnum.GPT_4O, ChatModeEnum.DEFAULT, 'benchmark', prints=False)
+    print("Fixture throughput")
+    results = {}
+    for index, fixture in enumerate(fixtures):
+        name = fixture.metadata.get('query') or f'fixture {index}'
+        events = parse_fixture(fixture)
+        megabytes = fixture.size / 1e6
+        parse_time = bench(f'parse [{name[:30]}]', parse_fixture, fixture)
+        client = YouChat(config)
+        replay(client, fixture)
+        replay_time = bench(f'replayed send_request [{name[:20]}]', replay_requests, client, config, 1)
+        client.close()
+        results[name] = {
+            'events_per_second': events / parse_time,
+            'megabytes_per_second': megabytes / parse_time,
+            'parse_peak_bytes': peak_allocated(parse_fixture, fixture),
+            'replay_megabytes_per_second': megabytes / replay_time,
+        }
+        print(f"{'':<40} {results[name]['events_per_second']:,.0f} events/s, "
+              f"{results[name]['megabytes_per_second']:.1f} MB/s parsed, "
+              f"{results[name]['replay_megabytes_per_second']:.1f} MB/s replayed, "
+              f"{results[name]['parse_peak_bytes'] / 1024:.0f} KiB peak")
+    return results
+
+
+def main(fixture_paths: Optional[List[str]] = None):
+    """Runs every micro-benchmark; recorded fixtures can be given as command-line arguments."""
+    bench_parsers()
+    bench_json_backends()
+    bench_subscriptions()
+    bench_query_encoding()
+    bench_request_building()
+    bench_fixtures([SSEFixture.load(path) for path in fixture_paths or []])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,233 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from YouChat import AdaptiveConcurrencyLimiter, AsyncYouChat, StreamMetrics, YouChat
+
+# Prometheus text exposition format, version 0.0.4
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 30.0, 60.0)
+GAP_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+Labels = Tuple[str, str]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _chain(existing: Optional[Callable[[StreamMetrics], None]],
+           hook: Callable[[StreamMetrics], None]) -> Callable[[StreamMetrics], None]:
+    # Calls an already installed hook before the new one; installing the same hook twice is a no-op
+    if existing is None or existing == hook or hook in getattr(existing, 'hooks', ()):
+        return existing or hook
+
+    def chained(metrics: StreamMetrics):
+        existing(metrics)
+        hook(metrics)
+
+    chained.hooks = getattr(existing, 'hooks', (existing,)) + (hook,)
+    return chained
+
+
+class Histogram:
+    """Fixed-bucket histogram; not locked itself, PrometheusExporter serializes updates."""
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_many(self, values: List[float]):
+        for value in values:
+            self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += sum(values)
+        self.count += len(values)
+
+
+class PrometheusExporter:
+    """Collects StreamMetrics from YouChat clients into Prometheus series labeled by model and chat mode.
+
+    Nothing is recorded per token: clients only timestamp tokens on their own StreamMetrics, and the
+    exporter folds each finished stream into its series under one short lock acquisition.
+    """
+
+    label_names = ('model', 'chat_mode')
+    histograms = (
+        ('youchat_connect_seconds', 'Time spent opening new connections.', 'connect_time', LATENCY_BUCKETS),
+        ('youchat_time_to_headers_seconds', 'Time until the response headers arrived.', 'time_to_headers', LATENCY_BUCKETS),
+        ('youchat_time_to_first_token_seconds', 'Time until the first youChatToken arrived.', 'time_to_first_token', LATENCY_BUCKETS),
+        ('youchat_request_duration_seconds', 'Total time spent streaming a response.', 'duration', LATENCY_BUCKETS),
+    )
+    counters = (
+        ('youchat_requests_total', 'Streamed requests that finished, including failed ones.'),
+        ('youchat_cache_hits_total', 'Requests answered from the response cache.'),
+        ('youchat_tokens_total', 'youChatToken events received.'),
+        ('youchat_received_bytes_total', 'Response body bytes received.'),
+        ('youchat_retries_total', 'Extra attempts made by retry policies.'),
+        ('youchat_hedges_total', 'Duplicate requests sent by hedge policies.'),
+        ('youchat_hedge_wins_total', 'Hedged requests answered by the duplicate.'),
+    )
+
+    def __init__(self, latency_buckets: Iterable[float] = LATENCY_BUCKETS, gap_buckets: Iterable[float] = GAP_BUCKETS):
+        self._lock = threading.Lock()
+        self._latency_buckets = tuple(latency_buckets)
+        self._gap_buckets = tuple(gap_buckets)
+        self._counters: Dict[Labels, List[int]] = {}
+        self._errors: Dict[Tuple[str, str, str], int] = {}
+        self._active: Dict[Labels, int] = {}
+        self._started: Dict[int, Labels] = {}  # id(metrics) -> labels the stream was counted as active under
+        self._histograms: Dict[Labels, List[Histogram]] = {}
+        self._gaps: Dict[Labels, Histogram] = {}
+        self._limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+
+    def instrument(self, client: Union[YouChat, AsyncYouChat]) -> Union[YouChat, AsyncYouChat]:
+        """Reports the client's streams to this exporter and returns the client.
+
+        Hooks the client already has, such as a LatencyRecorder, keep being called.
+        """
+        client.metrics_hook = _chain(client.metrics_hook, self)
+        client.on_stream_start = _chain(client.on_stream_start, self.stream_started)
+        return client
+
+    def watch_limiter(self, limiter: AdaptiveConcurrencyLimiter, name: str = 'default') -> AdaptiveConcurrencyLimiter:
+        """Exports the limiter's current limit, in-flight and waiting requests and limit changes under `name`."""
+        with self._lock:
+            self._limiters[name] = limiter
+        return limiter
+
+    @staticmethod
+    def _labels(metrics: StreamMetrics) -> Labels:
+        return metrics.model.name, metrics.chat_mode.value
+
+    def stream_started(self, metrics: StreamMetrics):
+        labels = self._labels(metrics)
+        with self._lock:
+            self._active[labels] = self._active.get(labels, 0) + 1
+            self._started[id(metrics)] = labels
+
+    def __call__(self, metrics: StreamMetrics):
+        # A fallback or hedge may change metrics.model mid-stream; the active gauge is decremented
+        # under the labels it was incremented with, everything else is recorded under the final model
+        labels = self._labels(metrics)
+        with self._lock:
+            started = self._started.pop(id(metrics), None)
+            if started is not None:
+                self._active[started] -= 1
+            counters = self._counters.get(labels)
+            if counters is None:
+                counters = self._counters[labels] = [0] * len(self.counters)
+                self._histograms[labels] = [Histogram(self._latency_buckets) for _ in self.histograms]
+                self._gaps[labels] = Histogram(self._gap_buckets)
+            counters[0] += 1
+            counters[1] += metrics.cached
+            counters[2] += metrics.token_count
+            counters[3] += metrics.bytes_received
+            counters[4] += max(len(metrics.attempts) - 1, 0)
+            counters[5] += metrics.hedged
+            counters[6] += metrics.hedge_won
+            if metrics.error is not None:
+                error_labels = labels + (metrics.error,)
+                self._errors[error_labels] = self._errors.get(error_labels, 0) + 1
+            for histogram, (_, _, attribute, _) in zip(self._histograms[labels], self.histograms):
+                value = getattr(metrics, attribute)
+                if value is not None:
+                    histogram.observe(value)
+            self._gaps[labels].observe_many(metrics.inter_token_gaps)
+
+    def _histogram_lines(self, name: str, help_text: str, series: Dict[Labels, Histogram]) -> List[str]:
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for labels, histogram in series.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names + ('le',), labels + (_format_value(bound),))
+                lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f'{name}_sum{label_text} {_format_value(histogram.sum)}')
+            lines.append(f'{name}_count{label_text} {histogram.count}')
+        return lines
+
+    def exposition(self) -> str:
+        """Renders every series in the Prometheus text exposition format."""
+        with self._lock:
+            counters = {labels: list(values) for labels, values in self._counters.items()}
+            errors = dict(self._errors)
+            active = dict(self._active)
+            histograms = {labels: [self._copy(h) for h in values] for labels, values in self._histograms.items()}
+            gaps = {labels: self._copy(h) for labels, h in self._gaps.items()}
+            limiters = dict(self._limiters)
+
+        lines = []
+        for index, (name, help_text) in enumerate(self.counters):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [f'{name}{_format_labels(self.label_names, labels)} {values[index]}' for labels, values in counters.items()]
+        lines += ['# HELP youchat_request_errors_total Streamed requests that raised, by exception type.',
+                  '# TYPE youchat_request_errors_total counter']
+        lines += [f'youchat_request_errors_total{_format_labels(self.label_names + ("error",), labels)} {count}'
+                  for labels, count in errors.items()]
+        lines += ['# HELP youchat_active_streams Streams currently being read.', '# TYPE youchat_active_streams gauge']
+        lines += [f'youchat_active_streams{_format_labels(self.label_names, labels)} {count}' for labels, count in active.items()]
+        for index, (name, help_text, _, _) in enumerate(self.histograms):
+            lines += self._histogram_lines(name, help_text, {labels: values[index] for labels, values in histograms.items()})
+        lines += self._histogram_lines('youchat_inter_token_gap_seconds', 'Time between consecutive youChatTokens.', gaps)
+        limiter_stats = {name: limiter.stats for name, limiter in limiters.items()}
+        for name, kind, key, help_text in (
+            ('youchat_concurrency_limit', 'gauge', 'limit', 'Current adaptive concurrency limit.'),
+            ('youchat_concurrency_in_flight', 'gauge', 'in_flight', 'Requests holding a concurrency slot.'),
+            ('youchat_concurrency_waiting', 'gauge', 'waiting', 'Requests waiting for a concurrency slot.'),
+            ('youchat_concurrency_limit_increases_total', 'counter', 'increases', 'Additive increases of the concurrency limit.'),
+            ('youchat_concurrency_limit_decreases_total', 'counter', 'decreases', 'Multiplicative decreases of the concurrency limit.'),
+        ):
+            if limiter_stats:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+                lines += [f'{name}{_format_labels(("limiter",), (limiter_name,))} {stats[key]}' for limiter_name, stats in limiter_stats.items()]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _copy(histogram: Histogram) -> Histogram:
+        copy = Histogram(histogram.buckets)
+        copy.counts, copy.sum, copy.count = list(histogram.counts), histogram.sum, histogram.count
+        return copy
+
+    def serve(self, port: int = 9464, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Serves the exposition at http://host:port/metrics from a daemon thread; call shutdown() to stop it."""
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='youchat-metrics', daemon=True).start()
+        return server
@@ -0,0 +1,293 @@
+import argparse
+import asyncio
+import json
+import random
+import threading
+import uuid
+from dataclasses import dataclass
+from http.cookies import SimpleCookie
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+STREAMING_PATH = '/api/streamingSearch'
+WORDS = ('the', 'air', 'quality', 'index', 'in', 'new', 'delhi', 'is', 'currently', 'moderate', 'with', 'levels',
+         'of', 'pm2.5', 'expected', 'to', 'improve', 'later', 'today', 'according', 'local', 'monitoring', 'stations')
+
+
+@dataclass
+class MockServerConfig:
+    """Behaviour of MockStreamingServer; rates are probabilities between 0 and 1 and times are in seconds."""
+    tokens: int = 50
+    token_rate: Optional[float] = 50.0  # tokens per second, None streams them as fast as possible
+    latency: float = 0.0  # delay before the response headers
+    think_time: float = 0.0  # delay between the headers and the first token
+    token_size: int = 6  # approximate characters per token
+    search_results: int = 0  # thirdPartySearchResults entries, to make payloads larger
+    related_searches: int = 3
+    error_rate: float = 0.0  # requests answered with `error_status` instead of a stream
+    error_status: int = 500
+    drop_rate: float = 0.0  # streams whose connection is cut before the last token
+    capacity: Optional[int] = None  # concurrent streams served; requests beyond it are answered with 429
+    seed: Optional[int] = None
+
+
+class MockStreamingServer:
+    """Local asyncio stand-in for you.com's streamingSearch endpoint, for load tests and offline runs.
+
+    It accepts the same query parameters and cookies as the real API and answers with chunked
+    `event:`/`data:` frames (query, optional thirdPartySearchResults, youChatToken, relatedSearches
+    and done). Point a client at `server.url` with `YouChatConfig(base_url=...)`.
+    """
+
+    def __init__(self, config: Optional[MockServerConfig] = None, host: str = '127.0.0.1', port: int = 0):
+        self.config = config or MockServerConfig()
+        self.host = host
+        self.port = port
+        self.stats: Dict[str, int] = {'requests': 0, 'streams': 0, 'errors': 0, 'drops': 0, 'active': 0}
+        self._random = random.Random(self.config.seed)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set['asyncio.Task[None]'] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self) -> 'MockStreamingServer':
+        """Starts listening on the running event loop."""
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        """Stops listening and closes open connections, including idle keep-alive ones."""
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+    async def __aenter__(self) -> 'MockStreamingServer':
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start_in_thread(self) -> 'MockStreamingServer':
+        """Runs the server on its own event loop in a daemon thread, for use from synchronous code."""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='youchat-mock-server', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        """Stops a server started with start_in_thread."""
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self) -> 'MockStreamingServer':
+        return self.start_in_thread()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, headers = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if not await self._respond(writer, method, target, headers, keep_alive) or not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # close() cancels handlers; finish quietly instead of surfacing the cancellation to asyncio's callback
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    async def _respond(self, writer: asyncio.StreamWriter, method: str, target: str,
+                       headers: Dict[str, str], keep_alive: bool) -> bool:
+        # Returns False when the connection was dropped on purpose and must not be reused
+        self.stats['requests'] += 1
+        url = urlsplit(target)
+        if method == 'HEAD':
+            await self._send_simple(writer, 200, b'', keep_alive, head=True)
+            return True
+        if method != 'GET' or url.path != STREAMING_PATH:
+            await self._send_simple(writer, 404, b'Not Found', keep_alive)
+            return True
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if 'q' not in params:
+            await self._send_simple(writer, 400, b'Missing q parameter', keep_alive)
+            return True
+
+        config = self.config
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        if self._random.random() < config.error_rate:
+            self.stats['errors'] += 1
+            await self._send_simple(writer, config.error_status, b'Injected error', keep_alive)
+            return True
+
+        if config.capacity is not None and self.stats['active'] >= config.capacity:
+            self.stats['errors'] += 1
+            await self._send_simple(writer, 429, b'Too Many Requests', keep_alive)
+            return True
+
+        cookies = SimpleCookie(headers.get('cookie', ''))
+        self.stats['streams'] += 1
+        self.stats['active'] += 1
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n'
+                         b'Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n'
+                         + (b'Connection: keep-alive\r\n\r\n' if keep_alive else b'Connection: close\r\n\r\n'))
+            drop_at = self._random.randrange(config.tokens) if self._random.random() < config.drop_rate and config.tokens else None
+            await self._stream(writer, params, cookies, drop_at)
+            if drop_at is not None:
+                self.stats['drops'] += 1
+                writer.transport.abort()
+                return False
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+            return True
+        finally:
+            self.stats['active'] -= 1
+
+    async def _stream(self, writer: asyncio.StreamWriter, params: Dict[str, str], cookies: SimpleCookie,
+                      drop_at: Optional[int]):
+        config = self.config
+        model = params.get('selectedAiModel') or (cookies['ai_model'].value if 'ai_model' in cookies else 'unknown')
+        self._send_event(writer, 'query', {
+            'query': params['q'], 'chatId': params.get('chatId', str(uuid.uuid4())),
+            'queryTraceId': params.get('queryTraceId', ''), 'selectedAiModel': model,
+            'selectedChatMode': params.get('selectedChatMode', 'default'),
+        })
+        if config.search_results:
+            self._send_event(writer, 'thirdPartySearchResults', {'search': {'third_party_search_results': [
+                {'url': f'https://example.com/{i}', 'name': f'Result {i}', 'snippet': ' '.join(WORDS)}
+                for i in range(config.search_results)
+            ]}})
+        await writer.drain()
+        if config.think_time:
+            await asyncio.sleep(config.think_time)
+        interval = 1.0 / config.token_rate if config.token_rate else 0.0
+        loop = asyncio.get_running_loop()
+        next_token = loop.time()
+        for index in range(config.tokens):
+            if writer.is_closing():
+                # The client went away; unpaced streams only drain every 64 tokens, so stop writing here
+                return
+            if index == drop_at:
+                await writer.drain()
+                return
+            self._send_event(writer, 'youChatToken', {'youChatToken': self._token()})
+            if interval:
+                await writer.drain()
+                next_token += interval
+                delay = next_token - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif index % 64 == 63:
+                await writer.drain()
+        self._send_event(writer, 'relatedSearches', {'relatedSearches': [
+            f"{params['q']} {WORDS[i % len(WORDS)]}" for i in range(config.related_searches)
+        ]})
+        self._send_frame(writer, b"event: done\ndata: I'm done\n\n")
+        await writer.drain()
+
+    def _token(self) -> str:
+        words, size = [], 0
+        while size < self.config.token_size:
+            word = self._random.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return ' '.join(words) + ' '
+
+    def _send_event(self, writer: asyncio.StreamWriter, event: str, data: dict):
+        self._send_frame(writer, f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+
+    @staticmethod
+    def _send_frame(writer: asyncio.StreamWriter, frame: bytes):
+        writer.write(b'%x\r\n%s\r\n' % (len(frame), frame))
+
+    @staticmethod
+    async def _send_simple(writer: asyncio.StreamWriter, status: int, body: bytes, keep_alive: bool, head: bool = False):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 429: 'Too Many Requests'}.get(status, 'Error')
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1')
+                     + (b'' if head else body))
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for you.com's streamingSearch endpoint.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    defaults = MockServerConfig()
+    parser.add_argument('--tokens', type=int, default=defaults.tokens)
+    parser.add_argument('--token-rate', type=float, default=defaults.token_rate, help='tokens per second, 0 for unpaced')
+    parser.add_argument('--latency', type=float, default=defaults.latency)
+    parser.add_argument('--think-time', type=float, default=defaults.think_time)
+    parser.add_argument('--token-size', type=int, default=defaults.token_size)
+    parser.add_argument('--search-results', type=int, default=defaults.search_results)
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate)
+    parser.add_argument('--error-status', type=int, default=defaults.error_status)
+    parser.add_argument('--drop-rate', type=float, default=defaults.drop_rate)
+    parser.add_argument('--capacity', type=int, default=None, help='concurrent streams before answering 429')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    config = MockServerConfig(
+        tokens=args.tokens, token_rate=args.token_rate or None, latency=args.latency, think_time=args.think_time,
+        token_size=args.token_size, search_results=args.search_results, error_rate=args.error_rate,
+        error_status=args.error_status, drop_rate=args.drop_rate, capacity=args.capacity,
+        seed=args.seed,
+    )
+
+    async def serve():
+        server = await MockStreamingServer(config, args.host, args.port).start()
+        print(f"Serving {server.url}{STREAMING_PATH}")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import base64
+import json
+import time
+from dataclasses import dataclass, field
+from itertools import cycle
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from YouChat import YouChat, YouChatConfig, iter_response_bytes
+
+FIXTURE_VERSION = 1
+
+
+@dataclass
+class SSEFixture:
+    """A recorded streamingSearch response: the raw body chunks and when each one arrived."""
+    chunks: List[bytes]
+    offsets: List[float]
+    status: int = 200
+    content_type: str = 'text/event-stream; charset=utf-8'
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_body(cls, body: bytes, chunk_size: int = 1000, **metadata) -> 'SSEFixture':
+        """Builds an untimed fixture from a complete body, e.g. a synthetic stream."""
+        chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        return cls(chunks, [0.0] * len(chunks), metadata=metadata)
+
+    @property
+    def body(self) -> bytes:
+        return b''.join(self.chunks)
+
+    @property
+    def size(self) -> int:
+        return sum(map(len, self.chunks))
+
+    def save(self, path: str):
+        """Writes the fixture as JSON, with chunks base64-encoded so split UTF-8 sequences survive."""
+        document = {
+            'version': FIXTURE_VERSION,
+            'status': self.status,
+            'content_type': self.content_type,
+            'metadata': self.metadata,
+            'chunks': [[offset, base64.b64encode(chunk).decode('ascii')] for offset, chunk in zip(self.offsets, self.chunks)],
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(document, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'SSEFixture':
+        with open(path, encoding='utf-8') as f:
+            document = json.load(f)
+        if document.get('version') != FIXTURE_VERSION:
+            raise ValueError(f"Unsupported fixture version {document.get('version')!r} in {path}.")
+        return cls([base64.b64decode(chunk) for _, chunk in document['chunks']],
+                   [offset for offset, _ in document['chunks']],
+                   document['status'], document['content_type'], document['metadata'])
+
+
+def record_fixture(client: YouChat, query: str, path: Optional[str] = None,
+                   config: Optional[YouChatConfig] = None) -> SSEFixture:
+    """Sends one live request and captures its raw SSE body, chunk by chunk, optionally saving it to `path`."""
+    config = config or client.config
+    url, cookies = client.request_builder(config).build(client.prepare_query(query))
+    start = time.perf_counter()
+    chunks, offsets = [], []
+    with client.session.get(url, cookies=cookies, stream=True) as response:
+        for chunk in iter_response_bytes(response):
+            offsets.append(time.perf_counter() - start)
+            chunks.append(chunk)
+    fixture = SSEFixture(chunks, offsets, response.status_code,
+                         response.headers.get('Content-Type', 'text/event-stream'),
+                         {'query': query, 'model': config.model.name, 'chat_mode': config.chat_mode.value})
+    if path is not None:
+        fixture.save(path)
+    return fixture
+
+
+class ReplayStream:
+    """File-like response body that yields a fixture's chunks, paced by `speed` (None for no delays)."""
+
+    chunked = True
+
+    def __init__(self, fixture: SSEFixture, speed: Optional[float] = None):
+        self.fixture = fixture
+        self.speed = speed
+        self.closed = False
+        self._chunks = self._paced()
+        self._pending = b''
+
+    def _paced(self) -> Iterator[bytes]:
+        start = time.perf_counter()
+        for offset, chunk in zip(self.fixture.offsets, self.fixture.chunks):
+            if self.speed:
+                delay = offset / self.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield chunk
+
+    def stream(self, amt: Optional[int] = None, decode_content: bool = True) -> Iterator[bytes]:
+        while not self.closed:
+            chunk = self.read1(amt)
+            if not chunk:
+                break
+            yield chunk
+
+    def read1(self, amt: Optional[int] = None, decode_content: bool = True) -> bytes:
+        if not self._pending:
+            self._pending = next(self._chunks, b'')
+        if amt is None or amt >= len(self._pending):
+            chunk, self._pending = self._pending, b''
+        else:
+            chunk, self._pending = self._pending[:amt], self._pending[amt:]
+        return chunk
+
+    def read(self, amt: Optional[int] = None, decode_content: bool = True) -> bytes:
+        if amt is None:
+            return b''.join(self.stream())
+        parts, size = [], 0
+        while size < amt:
+            chunk = self.read1(amt - size)
+            if not chunk:
+                break
+            parts.append(chunk)
+            size += len(chunk)
+        return b''.join(parts)
+
+    def close(self):
+        self.closed = True
+
+    def release_conn(self):
+        pass
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Transport adapter that answers every request with the next recorded fixture instead of the network.
+
+    `speed` replays chunks at the recorded pace (1.0), scaled (2.0 is twice as fast), or as fast as
+    possible (None). Fixtures are served in order and repeat once all have been used.
+    """
+
+    def __init__(self, fixtures: Union[SSEFixture, Iterable[SSEFixture]], speed: Optional[float] = None):
+        super().__init__()
+        fixtures = [fixtures] if isinstance(fixtures, SSEFixture) else list(fixtures)
+        if not fixtures:
+            raise ValueError("ReplayAdapter needs at least one fixture.")
+        self._fixtures = cycle(fixtures)
+        self.speed = speed
+        self.requests: List[str] = []
+
+    def send(self, request: requests.PreparedRequest, stream: bool = False, **kwargs) -> requests.Response:
+        self.requests.append(request.url)
+        fixture = next(self._fixtures)
+        response = requests.Response()
+        response.status_code = fixture.status
+        response.headers['Content-Type'] = fixture.content_type
+        response.raw = ReplayStream(fixture, self.speed)
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        if not stream:
+            response.content  # read the whole body now, like a non-streaming request
+        return response
+
+    def close(self):
+        pass
+
+
+def replay(client: YouChat, fixtures: Union[SSEFixture, Iterable[SSEFixture]],
+           speed: Optional[float] = None) -> ReplayAdapter:
+    """Routes the client's requests to its base URL through a ReplayAdapter and returns the adapter."""
+    adapter = ReplayAdapter(fixtures, speed)
+    client.session.session.mount(client.base_url, adapter)
+    return adapter